@@ -22,15 +22,21 @@ index = {"QuantileCalibrator": "01_ensemble.ipynb",
          "JointKernelTreeEstimator": "01_ensemble.ipynb",
          "agg_smallest_distance": "04_metrics.ipynb",
          "KDE": "02_core.random_variable.ipynb",
+         "BatchKDE": "02_core.random_variable.ipynb",
          "Empirical": "02_core.random_variable.ipynb",
          "RandomVariable": "02_core.random_variable.ipynb",
          "CustomArray": "02_core.random_variable.ipynb",
          "RVArray": "02_core.random_variable.ipynb",
+         "BatchRVArray": "02_core.random_variable.ipynb",
          "ctqdm": "03_utils.ipynb",
          "pad_to_shape": "03_utils.ipynb",
          "fix_samples_shape": "03_utils.ipynb",
+         "cumulative_encode": "03_utils.ipynb",
          "count_unique_by_row": "03_utils.ipynb",
+         "check_random_generator": "03_utils.ipynb",
          "sample_idxs": "03_utils.ipynb",
+         "inverse_cdf_sample": "03_utils.ipynb",
+         "categorical_sample": "03_utils.ipynb",
          "draw_from": "03_utils.ipynb",
          "sample_multi_dim": "03_utils.ipynb",
          "sample_from_dist_array": "03_utils.ipynb",
@@ -38,14 +44,26 @@ index = {"QuantileCalibrator": "01_ensemble.ipynb",
          "add_multivariate_noise": "03_utils.ipynb",
          "sparse_mul_col": "03_utils.ipynb",
          "sparse_mul_row": "03_utils.ipynb",
+         "transform_query_vector": "03_utils.ipynb",
+         "transform_query_space": "03_utils.ipynb",
          "transform_similarity_weights": "03_utils.ipynb",
          "sparse_dot_product": "03_utils.ipynb",
+         "dump_csr": "03_utils.ipynb",
+         "load_csr": "03_utils.ipynb",
+         "dump_arrays": "03_utils.ipynb",
+         "load_arrays": "03_utils.ipynb",
+         "auto_n_batches": "03_utils.ipynb",
          "make_batches": "03_utils.ipynb",
+         "csr_topk_to_dense": "03_utils.ipynb",
          "cos_sim_query": "03_utils.ipynb",
+         "LeafEncoder": "03_utils.ipynb",
+         "InvertedIndex": "03_utils.ipynb",
          "sigmoid": "03_utils.ipynb",
          "make_bimodal_regression": "03_utils.ipynb",
          "make_distplot": "03_utils.ipynb",
          "DelegateEstimatorMixIn": "03_utils.ipynb",
+         "chunk_slices": "03_utils.ipynb",
+         "ChunkedPredictMixIn": "03_utils.ipynb",
          "kde_entropy": "04_metrics.ipynb",
          "kde_likelihood": "04_metrics.ipynb",
          "ppf": "04_metrics.ipynb",
@@ -55,6 +73,8 @@ index = {"QuantileCalibrator": "01_ensemble.ipynb",
          "quantile_sklearn": "04_metrics.ipynb",
          "theoretical_entropy": "04_metrics.ipynb",
          "marginal_variance": "04_metrics.ipynb",
+         "weighted_moments": "04_metrics.ipynb",
+         "weighted_quantile": "04_metrics.ipynb",
          "covariance_matrix": "04_metrics.ipynb",
          "bimodal_split": "04_metrics.ipynb",
          "cov_smallest_distance": "04_metrics.ipynb",
@@ -1,7 +1,7 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: notebooks/02_core.random_variable.ipynb (unless otherwise specified).
 
-__all__ = ['identity_func', 'agg_smallest_distance', 'KDE', 'IDENTITY_TRANSFORMER', 'Empirical', 'RandomVariable',
-           'CustomArray', 'RVArray']
+__all__ = ['identity_func', 'agg_smallest_distance', 'KDE', 'BatchKDE', 'IDENTITY_TRANSFORMER', 'Empirical',
+           'RandomVariable', 'CustomArray', 'RVArray', 'BatchRVArray']
 
 # Cell
 from functools import partial
@@ -9,18 +9,20 @@ from warnings import warn
 
 import scipy
 import scipy.stats as stats
+from scipy.special import ndtr
+from scipy.interpolate import RegularGridInterpolator
 import numpy as np
 from sklearn.metrics.pairwise import euclidean_distances
-from sklearn.preprocessing import QuantileTransformer, FunctionTransformer
+from sklearn.preprocessing import QuantileTransformer, FunctionTransformer, normalize
 from sklearn.neighbors import KernelDensity
 from sklearn.decomposition import PCA, KernelPCA
-
-import KDEpy as kdepy
-import awkde
+from sklearn.utils.fixes import _joblib_parallel_args
+from joblib import Parallel, delayed, effective_n_jobs
 
 from ..utils import (
-    cos_sim_query, sample_multi_dim, ctqdm, DelegateEstimatorMixIn, _vector_1d_to_matrix,_assert_dim_3d,_assert_dim_2d,
-    add_noise, _fix_X_1d, draw_from, _fix_one_sample_2d, _fix_one_dist_2d, _fix_dist_1d
+    cos_sim_query, sample_multi_dim, ctqdm, tqdm, DelegateEstimatorMixIn, _vector_1d_to_matrix,_assert_dim_3d,_assert_dim_2d,
+    add_noise, _fix_X_1d, draw_from, _fix_one_sample_2d, _fix_one_dist_2d, _fix_dist_1d, _empirical_quantile,
+    _add_n_dims_axis, inverse_cdf_sample, check_random_generator, chunk_slices
 )
 
 # Cell
@@ -54,7 +56,17 @@ class KDE():
 
     AVALIBLE_BW_METHODS = ['ISJ', 'scott', 'silverman', 'mean_distance', 'std_distance', 'median_distance']
 
-    def __init__(self, bw = 'std_distance', space_transformer = PCA, implementation = 'sklearn', st_kws = {}, **kde_kws):
+    def __init__(self, bw = 'std_distance', space_transformer = PCA, implementation = 'sklearn', st_kws = {}, grid_size = 2**16,
+                 cdf_grid_size = 2048, **kde_kws):
+        '''
+        implementation = 'fft' evaluates the kde once in a grid of about grid_size points (binned FFT convolution from KDEpy)
+        and interpolates. evaluate, cdf, ppf, entropy and sample are then computed from the grid, without monte carlo sampling.
+        it is meant for low dimensional (up to 3 dims) data. the grid covers the data range plus the kernel practical support
+        (a few bandwidths) in the transformed space, and evaluate returns 0 outside of it, so the log likelihood of points
+        far from the fitted data is -inf.
+        for gaussian kernels and linear space transformers (PCA or None), cdf and ppf are interpolated from the exact marginal cdfs,
+        tabulated once in cdf_grid_size points per dimension
+        '''
 
         if bw.__class__ == str:
             assert bw in self.AVALIBLE_BW_METHODS, f"if str, bw should be one of {self.AVALIBLE_BW_METHODS}, not {bw}"
@@ -64,10 +76,12 @@ class KDE():
         self._space_transformer = space_transformer if not space_transformer is None else IDENTITY_TRANSFORMER
         self.kde_kws = kde_kws
         self.st_kws = st_kws
-        if not implementation in ['scipy','sklearn','awkde']:
-            raise ValueError(f'implementation should be one of ["sklearn","scipy","awkde"], not {implementation}')
+        if not implementation in ['scipy','sklearn','awkde','fft']:
+            raise ValueError(f'implementation should be one of ["sklearn","scipy","awkde","fft"], not {implementation}')
 
         self.implementation = implementation
+        self.grid_size = grid_size
+        self.cdf_grid_size = cdf_grid_size
 
     def _check_X_2d(self,X):
         X = np.array(X)
@@ -81,6 +95,7 @@ class KDE():
 
     def _get_bw_each_dim(self, X, bw_method):
         if bw_method in ['ISJ', 'scott', 'silverman']:
+            import KDEpy as kdepy
             return np.array([kdepy.FFTKDE(bw = bw_method).bw(X[:,i:i+1]) for i in range(X.shape[-1])])
         elif bw_method == 'mean_distance':
             return np.array([agg_smallest_distance(X[:,i].reshape(1,X.shape[0],1), np.mean) for i in range(X.shape[-1])])
@@ -89,19 +104,29 @@ class KDE():
         elif bw_method == 'std_distance':
             return np.array([agg_smallest_distance(X[:,i].reshape(1,X.shape[0],1), np.std) for i in range(X.shape[-1])])
 
-    def _preprocess_fit(self, X):
+    def _preprocess_fit(self, X, sample_weight = None):
         '''
-        preprocess data prior to fit. ensure len >2 and add some white noise to avoid eigenvalues errors in space transform
+        preprocess data prior to fit. ensure len >2 and add some white noise to avoid eigenvalues errors in space transform.
+        sample_weight should have one weight per row of X, and is repeated along with X
         '''
         X = self._check_X_2d(X)
+        if not sample_weight is None:
+            sample_weight = np.asarray(sample_weight, dtype = float)
+            if sample_weight.shape != (len(X),):
+                raise ValueError(f'sample_weight should be of shape ({len(X)},), got {sample_weight.shape} instead')
         if len(X) < 2:
             X = np.concatenate([X,X])
+            sample_weight = None if sample_weight is None else np.concatenate([sample_weight,sample_weight])
         X = add_noise(X, 1e-9)
-        return X
+        return X, sample_weight
 
     def fit(self, X, y = None, sample_weight = None):
         #preprocess X
-        X = self._preprocess_fit(X)
+        X, sample_weight = self._preprocess_fit(X, sample_weight)
+        self._kernel_centers = X
+        self._kernel_weights = np.ones(len(X)) if sample_weight is None else sample_weight
+        self._kernel_weights = self._kernel_weights/self._kernel_weights.sum()
+        self._grid_marginal_values, self._grid_marginal_cdf = None, None
         #fit and transform X with manifold learner (self.space_transformer)
         if isinstance(self._space_transformer, type):
             self._space_transformer = self._space_transformer(**{**self.st_kws, **{
@@ -124,15 +149,23 @@ class KDE():
         elif self.implementation == 'scipy':
             self.estimator = stats.gaussian_kde(X.T, bw_method = bw)
         elif self.implementation == 'awkde':
+            import awkde
             self.estimator = awkde.GaussianKDE(**{**{'glob_bw':bw},**self.kde_kws})
             self.estimator.fit(X = X, weights = sample_weight)
-        else: raise ValueError(f'self.implementation should be one of ["sklearn","scipy","awkde"], not {self.implementation}')
+        elif self.implementation == 'fft':
+            import KDEpy as kdepy
+            self.estimator = kdepy.FFTKDE(**{**{'bw':bw},**self.kde_kws}).fit(X, weights = sample_weight)
+            self._fit_grid(X)
+        else: raise ValueError(f'self.implementation should be one of ["sklearn","scipy","awkde","fft"], not {self.implementation}')
 
         self._transformed_bw_value = bw
         self.n_dim = X.shape[-1]
         return self
 
     def evaluate(self, data):
+        '''
+        density of data points. with implementation = 'fft', points outside the fitted grid have density 0
+        '''
         data = self._check_X_2d(data)
         #transform input
         data = self._space_transformer.transform(data)
@@ -144,7 +177,9 @@ class KDE():
             likelihood = self.estimator.pdf(data.T)
         elif self.implementation == 'awkde':
             likelihood = self.estimator.predict(data)
-        else: raise ValueError(f'self.implementation should be one of ["sklearn","scipy","awkde"], not {self.implementation}')
+        elif self.implementation == 'fft':
+            likelihood = self._grid_interpolator(data)
+        else: raise ValueError(f'self.implementation should be one of ["sklearn","scipy","awkde","fft"], not {self.implementation}')
 
         return likelihood
 
@@ -162,7 +197,9 @@ class KDE():
             samples = self.estimator.resample(sample_size, random_state).T
         elif self.implementation == 'awkde':
             samples = self.estimator.sample(n_samples = sample_size, random_state = random_state)
-        else: raise ValueError(f'self.implementation should be one of ["sklearn","scipy","awkde"], not {self.implementation}')
+        elif self.implementation == 'fft':
+            samples = self._grid_sample(sample_size, random_state)
+        else: raise ValueError(f'self.implementation should be one of ["sklearn","scipy","awkde","fft"], not {self.implementation}')
         #inverse transform samples
         samples = self._space_transformer.inverse_transform(samples)
         return samples
@@ -171,21 +208,119 @@ class KDE():
         return self.rvs(sample_size, random_state)
 
     def entropy(self, sample_size = 100):
+        if self.implementation == 'fft':
+            #integrate -p*log2(p) over the grid
+            mass = self._grid_mass[self._grid_mass > 0]
+            return -np.sum(mass*np.log2(mass/self._grid_cell_volume))
         return np.mean(-np.log2(self.evaluate(self.rvs(size = sample_size))))
 
     def cdf(self, data, sample_size = 1000):
+        if self._has_tabulated_cdf():
+            data = self._check_X_2d(data)
+            values = np.column_stack([
+                np.interp(data[:,dim], self._grid_marginal_values[dim], self._grid_marginal_cdf[dim], left = 0, right = 1)
+                for dim in range(data.shape[-1])
+            ])
+            return values.reshape(1, *values.shape)
         samples = self.sample(sample_size = sample_size)
         # fix shape in order to work with _quantile
         samples = samples.reshape(1, *samples.shape)
         return _quantile(data.reshape(1, *data.shape), samples)
 
     def ppf(self, data, sample_size = 100):
-        #estimate using sampling and QuantileTransformer since integration is too costly
         data = np.array(data)
         assert (data.min() >= 0) and (data.max() <= 1), 'data contains values < 0 or > 1'
+        if self._has_tabulated_cdf():
+            data = self._check_X_2d(data)
+            return np.column_stack([
+                np.interp(data[:,dim], self._grid_marginal_cdf[dim], self._grid_marginal_values[dim])
+                for dim in range(data.shape[-1])
+            ])
+        #estimate using sampling and QuantileTransformer since integration is too costly
         samples = self.sample(sample_size = sample_size)
         return QuantileTransformer(n_quantiles = min(1000,samples.shape[0])).fit(samples).inverse_transform(data)
 
+    def _has_tabulated_cdf(self):
+        '''
+        checks if marginal cdfs can be (or already are) tabulated, building the table in the first call
+        '''
+        if self._grid_marginal_cdf is None:
+            linear_transformer = isinstance(self._space_transformer, PCA) or self._space_transformer is IDENTITY_TRANSFORMER
+            gaussian_kernel = self.implementation == 'scipy' or (
+                self.implementation == 'sklearn' and self.kde_kws.get('kernel', 'gaussian') == 'gaussian')
+            if not (linear_transformer and gaussian_kernel):
+                return False
+            self._tabulate_marginal_cdf()
+        return True
+
+    def _tabulate_marginal_cdf(self):
+        '''
+        tabulates the exact marginal cdf of each dimension in the original space, as the weighted sum of the kernels normal cdfs.
+        gaussian kernels in a linearly transformed space are gaussians in the original space as well,
+        with covariance linear_map.T @ kernel_cov @ linear_map
+        '''
+        n_dim = self._kernel_centers.shape[-1]
+        offset = self._space_transformer.inverse_transform(np.zeros((1, self.n_dim)))
+        linear_map = self._space_transformer.inverse_transform(np.eye(self.n_dim)) - offset
+        if self.implementation == 'scipy':
+            kernel_cov = self.estimator.covariance
+        else:
+            kernel_cov = np.eye(self.n_dim)*self._transformed_bw_value**2
+        scales = np.sqrt(np.maximum(np.diag(linear_map.T @ kernel_cov @ linear_map), 1e-24))
+
+        chunk_size = max(1, 2**22//self.cdf_grid_size)
+        self._grid_marginal_values, self._grid_marginal_cdf = [], []
+        for dim in range(n_dim):
+            centers = self._kernel_centers[:,dim]
+            grid = np.linspace(centers.min() - 8*scales[dim], centers.max() + 8*scales[dim], self.cdf_grid_size)
+            cdf = np.zeros(self.cdf_grid_size)
+            for i in range(0, len(centers), chunk_size):
+                z = (grid[:,None] - centers[None,i:i + chunk_size])/scales[dim]
+                cdf += ndtr(z) @ self._kernel_weights[i:i + chunk_size]
+            self._grid_marginal_values.append(grid)
+            self._grid_marginal_cdf.append(np.clip(cdf, 0, 1))
+        return self
+
+    def _fit_grid(self, X):
+        '''
+        evaluates the fitted FFTKDE in a regular grid (in the transformed space) and precomputes the interpolator,
+        the probability mass of each grid cell and the marginal cdfs of each dimension in the original space
+        '''
+        if X.shape[-1] > 3:
+            raise ValueError(f'fft implementation supports up to 3 dimensions, got {X.shape[-1]}')
+        points_per_dim = max(16, int(self.grid_size**(1/X.shape[-1])))
+        grid, density = self.estimator.evaluate(points_per_dim)
+        grid = grid.reshape(-1, X.shape[-1])
+        self._grid_axes = [np.unique(grid[:,dim]) for dim in range(grid.shape[-1])]
+        self._grid_interpolator = RegularGridInterpolator(
+            self._grid_axes, density.reshape([len(axis) for axis in self._grid_axes]), bounds_error = False, fill_value = 0)
+
+        steps = np.array([axis[1] - axis[0] for axis in self._grid_axes])
+        if steps.max() > self.estimator.bw:
+            warn(f'fft grid step ({steps.max():.3g}) is larger than bw ({self.estimator.bw:.3g}), so density will be smoother than the exact kde. consider increasing grid_size or bw')
+        self._grid_cell_volume = np.prod(steps)
+        self._grid_points = grid
+        self._grid_mass = density/density.sum()
+        self._grid_cumulative_mass = self._grid_mass.cumsum()
+        #marginal cdfs are computed in the original space, since space transformer may rotate or flip axes
+        original_grid = self._space_transformer.inverse_transform(grid)
+        self._grid_marginal_values, self._grid_marginal_cdf = [], []
+        for dim in range(original_grid.shape[-1]):
+            argsort = np.argsort(original_grid[:,dim], kind = 'stable')
+            self._grid_marginal_values.append(original_grid[argsort, dim])
+            self._grid_marginal_cdf.append(self._grid_mass[argsort].cumsum())
+        return self
+
+    def _grid_sample(self, sample_size, random_state = None):
+        '''
+        samples grid cells by probability mass (inverse cdf lookup) and spreads them uniformly inside each cell
+        '''
+        rng = check_random_generator(random_state)
+        idxs = np.searchsorted(self._grid_cumulative_mass, rng.random(sample_size)*self._grid_cumulative_mass[-1], side = 'right')
+        idxs = np.minimum(idxs, len(self._grid_points) - 1)
+        steps = np.array([axis[1] - axis[0] for axis in self._grid_axes])
+        return self._grid_points[idxs] + (rng.random((sample_size, len(steps))) - 0.5)*steps
+
     def _make_conditioning_grid(self, condition_dict = {}, resolution = None):
         samples, likelihood = self.sample(1000) #estimate min and max intervals
         argsrt = np.argsort(likelihood)[::-1]
@@ -202,6 +337,175 @@ class KDE():
                 dim_grid.append(np.linspace(condition_dict[dim],condition_dict[dim], resolution))
         return np.array(dim_grid).T
 
+# Cell
+class BatchKDE():
+    '''
+    gaussian KDE fitted on many distributions at once.
+    equivalent to fitting KDE(bw, space_transformer = PCA, implementation = 'sklearn') on each distribution,
+    but whitening, bandwidth and log density are computed with broadcasting over a stacked (n_dists, n_samples, n_dims) array.
+    operations are chunked along n_dists so that intermediate arrays fit in batch_memory (bytes)
+    '''
+
+    AVALIBLE_BW_METHODS = ['mean_distance', 'std_distance', 'median_distance']
+    BW_AGG_FUNCS = {'mean_distance':np.mean, 'std_distance':np.std, 'median_distance':np.median}
+
+    def __init__(self, bw = 'std_distance', whiten = True, batch_memory = 2**28):
+
+        if bw.__class__ == str:
+            assert bw in self.AVALIBLE_BW_METHODS, f"if str, bw should be one of {self.AVALIBLE_BW_METHODS}, not {bw}"
+        elif not isinstance(bw,(float, int, np.floating)):
+            raise TypeError(f'bw should be str or float, not {bw.__class__}')
+        self.bw = bw
+        self.whiten = whiten
+        self.batch_memory = batch_memory
+
+    @classmethod
+    def from_kde_kws(cls, batch_memory = 2**28, bw = 'std_distance', space_transformer = PCA, implementation = 'sklearn', st_kws = {}, **kde_kws):
+        '''
+        returns a BatchKDE equivalent to KDE(bw, space_transformer, implementation, st_kws, **kde_kws),
+        or None if that configuration is not supported by the batch engine
+        '''
+        if implementation != 'sklearn' or st_kws or not space_transformer in (PCA, None):
+            return None
+        if not set(kde_kws) <= {'kernel'} or kde_kws.get('kernel', 'gaussian') != 'gaussian':
+            return None
+        if bw.__class__ == str and not bw in cls.AVALIBLE_BW_METHODS:
+            return None
+        return cls(bw = bw, whiten = not space_transformer is None, batch_memory = batch_memory)
+
+    def _chunks(self, n_dists, row_size):
+        '''slices along n_dists such that chunk_size*row_size float64 values fit in self.batch_memory'''
+        chunk_size = max(1, int(self.batch_memory//(8*max(1, row_size))))
+        return [slice(i, min(i + chunk_size, n_dists)) for i in range(0, n_dists, chunk_size)]
+
+    def fit(self, X, sample_weight = None):
+        '''
+        X should be of shape (n_dists, n_samples, n_dims)
+        sample_weight can be None or an array of shape (n_dists, n_samples) with the kernel weights of each distribution
+        '''
+        X = _assert_dim_3d(np.asarray(X, dtype = float))
+        if not sample_weight is None:
+            sample_weight = _assert_dim_2d(np.asarray(sample_weight, dtype = float))
+            if sample_weight.shape != X.shape[:2]:
+                raise ValueError(f'sample_weight should be of shape {X.shape[:2]}, got {sample_weight.shape} instead')
+        if X.shape[1] < 2:
+            X = np.concatenate([X,X], axis = 1)
+            sample_weight = None if sample_weight is None else np.concatenate([sample_weight,sample_weight], axis = 1)
+        X = add_noise(X, 1e-9)
+        n_samples = X.shape[1]
+
+        #weights only change the kernel mixture. whitening ignores them, as the PCA space transformer of KDE does
+        self.weights_ = None if sample_weight is None else normalize(sample_weight, norm = 'l1')
+        self.mean_ = X.mean(axis = 1, keepdims = True)
+        centered = X - self.mean_
+        if self.whiten:
+            #same as PCA(whiten = True): project on covariance eigenvectors and divide by sqrt of eigenvalues
+            cov = np.einsum('nsi,nsj->nij', centered, centered)/(n_samples - 1)
+            eigvals, eigvecs = np.linalg.eigh(cov)
+            eigvals = np.maximum(eigvals, 1e-300)
+            self.whitening_ = eigvecs/np.sqrt(eigvals)[:,None,:]
+            self.scale_ = np.sqrt(np.maximum(np.diagonal(cov, axis1 = 1, axis2 = 2), 0))
+        else:
+            self.whitening_ = np.broadcast_to(np.eye(X.shape[-1]), (X.shape[0], X.shape[-1], X.shape[-1]))
+            self.scale_ = np.ones((X.shape[0], X.shape[-1]))
+
+        self.data_ = X
+        self.transformed_data_ = centered @ self.whitening_
+
+        if self.bw.__class__ == str:
+            bw = agg_smallest_distance(self.transformed_data_, self.BW_AGG_FUNCS[self.bw])
+            bw = np.sqrt(np.sum(bw**2, axis = -1))
+        else:
+            bw = np.full(X.shape[0], float(self.bw))
+        #ensure bw is positive
+        self.bw_ = np.maximum(1e-6, bw)
+        self.n_dim = X.shape[-1]
+        return self
+
+    def _check_points(self, data):
+        data = _assert_dim_3d(np.asarray(data, dtype = float))
+        if data.shape[0] != self.data_.shape[0] or data.shape[-1] != self.n_dim:
+            raise ValueError(f'data should be of shape ({self.data_.shape[0]}, n_points, {self.n_dim}), got {data.shape} instead')
+        return data
+
+    def _log_evaluate_transformed(self, data):
+        '''log density of points already in the whitened space, shape (n_dists, n_points)'''
+        n_dists, n_points, _ = data.shape
+        n_samples = self.transformed_data_.shape[1]
+        log_dens = np.empty((n_dists, n_points))
+        for chunk in self._chunks(n_dists, n_points*n_samples):
+            points, samples, bw = data[chunk], self.transformed_data_[chunk], self.bw_[chunk,None,None]
+            #log kernel values computed in place, since this is the largest array of the batch
+            log_kernel = np.einsum('nmd,nsd->nms', points, samples)
+            log_kernel *= -2
+            log_kernel += (points**2).sum(-1)[:,:,None]
+            log_kernel += (samples**2).sum(-1)[:,None,:]
+            np.maximum(log_kernel, 0, out = log_kernel)
+            log_kernel /= -2*bw**2
+            #logsumexp along samples axis
+            max_log_kernel = log_kernel.max(axis = -1, keepdims = True)
+            log_kernel -= max_log_kernel
+            np.exp(log_kernel, out = log_kernel)
+            if self.weights_ is None:
+                kernel_sum = log_kernel.sum(axis = -1)/n_samples
+            else:
+                kernel_sum = np.einsum('nms,ns->nm', log_kernel, self.weights_[chunk])
+            log_kernel_sum = np.log(kernel_sum) + max_log_kernel[:,:,0]
+            log_dens[chunk] = log_kernel_sum - 0.5*self.n_dim*np.log(2*np.pi*bw[:,:,0]**2)
+        return log_dens
+
+    def log_evaluate(self, data):
+        '''
+        log density of data (shape (n_dists, n_points, n_dims)) in each fitted distribution. returns shape (n_dists, n_points)
+        '''
+        data = self._check_points(data)
+        return self._log_evaluate_transformed((data - self.mean_) @ self.whitening_)
+
+    def evaluate(self, data):
+        return np.exp(self.log_evaluate(data))
+
+    def pdf(self, data):
+        return self.evaluate(data)
+
+    def _sample_transformed(self, sample_size, random_state = None):
+        rng = check_random_generator(random_state)
+        n_dists, n_samples, n_dims = self.transformed_data_.shape
+        if self.weights_ is None:
+            idxs = rng.integers(0, n_samples, size = (n_dists, sample_size))
+        else:
+            idxs = inverse_cdf_sample(self.weights_, sample_size, random_state = rng)
+        samples = np.take_along_axis(self.transformed_data_, idxs[:,:,None], axis = 1)
+        return samples + rng.normal(size = samples.shape)*self.bw_[:,None,None]
+
+    def sample(self, sample_size = 1, random_state = None):
+        '''returns array of shape (n_dists, sample_size, n_dims)'''
+        samples = self._sample_transformed(sample_size, random_state)
+        return samples @ np.linalg.inv(self.whitening_) + self.mean_
+
+    def entropy(self, sample_size = 100, random_state = None):
+        '''monte carlo estimate of the entropy (in bits) of each distribution, shape (n_dists,)'''
+        log_dens = self._log_evaluate_transformed(self._sample_transformed(sample_size, random_state))
+        return np.mean(-log_dens/np.log(2), axis = -1)
+
+    def cdf(self, data):
+        '''
+        exact marginal cdf of data (shape (n_dists, n_points, n_dims)) in each fitted distribution.
+        returns array of shape (n_dists, n_points, n_dims)
+        '''
+        data = self._check_points(data)
+        n_dists, n_points, n_dims = data.shape
+        n_samples = self.data_.shape[1]
+        cdf = np.empty(data.shape)
+        for chunk in self._chunks(n_dists, n_points*n_samples*n_dims):
+            #marginal kernel of each dim is a normal centered in each sample with std = bw*std of that dim
+            scale = (self.bw_[chunk,None]*self.scale_[chunk])[:,None,None,:]
+            z = (data[chunk][:,:,None,:] - self.data_[chunk][:,None,:,:])/scale
+            if self.weights_ is None:
+                cdf[chunk] = ndtr(z).mean(axis = 2)
+            else:
+                cdf[chunk] = np.einsum('nmsd,ns->nmd', ndtr(z), self.weights_[chunk])
+        return cdf
+
 # Cell
 def _check_kde_metrics_input(y_true, y_dists, frac):
     '''
@@ -293,13 +597,7 @@ def _quantile(y_true, y_dists):
     y_dists = _assert_dim_3d(y_dists)
     assert y_true.shape[0] == y_dists.shape[0], f'number of dists should be the same in both y_true and y_dists. got {y_true.shape[0]} and {y_dists.shape[0]}'
 
-    values = []
-    for i in range(y_true.shape[0]):
-        values.append([])
-        for j in range(y_true.shape[1]):
-            values[i].append((y_true[i,j].T >= y_dists[i]).mean(axis = 0))
-
-    return _fix_one_sample_2d(np.array(values))
+    return _empirical_quantile(y_true, y_dists)
 
 # Cell
 # CREATE EMPIRICAL DIST METHODS (WITH ADD NOISE IN SAMPLING OPTION AND ALL) <-----
@@ -334,7 +632,9 @@ class Empirical:
             assert X.shape[0] == sample_weight.shape[0], f'''
             X and sample_weight must be the same size along dimension 0. got {X.shape[0]} and {sample_weight.shape[0]}'''
             self.data = X
-            self.weights = sample_weight
+            #normalized, since weights are used as sampling probabilities
+            sample_weight = np.asarray(sample_weight, dtype = float)
+            self.weights = sample_weight/sample_weight.sum()
 
         return self
 
@@ -401,14 +701,60 @@ class Empirical:
         samples = samples.reshape(1,*samples.shape)
         return _kde_entropy(samples,**entropy_kws)
 
+# Cell
+def _fit_candidate(data, alias, dist_class, fit_kwargs, hist = None):
+    '''
+    fits a single candidate distribution. returns the fitted (frozen) distribution object
+    hist is the precomputed np.histogram of data, used by rv_histogram
+    '''
+    if alias == 'rv_histogram':
+        return dist_class(np.histogram(data, bins = 'auto') if hist is None else hist)
+    elif not alias in ['kde','empirical']:
+        params = dist_class.fit(data, **fit_kwargs)
+        return dist_class(*params)
+    else:
+        #fit kws passed to constructor in sklearn fashion, except sample_weight, which is passed to fit
+        fit_kwargs = dict(fit_kwargs)
+        sample_weight = fit_kwargs.pop('sample_weight', None)
+        if not sample_weight is None:
+            sample_weight = np.asarray(sample_weight)
+        return dist_class(**fit_kwargs).fit(data, sample_weight = sample_weight)
+
+def _fit_candidates(data, candidates, fit_kwargs, n_jobs = None):
+    '''
+    fits all candidates ((alias, dist_class) pairs) on the same data, concurrently if n_jobs is not None
+    '''
+    #histogram computed once and shared by rv_histogram candidates
+    hist = np.histogram(data, bins = 'auto') if any(alias == 'rv_histogram' for alias, _ in candidates) else None
+    if n_jobs is None or effective_n_jobs(n_jobs) == 1 or len(candidates) == 1:
+        return [_fit_candidate(data, alias, dist_class, fit_kwargs, hist) for alias, dist_class in candidates]
+    return Parallel(n_jobs = n_jobs)(
+        delayed(_fit_candidate)(data, alias, dist_class, fit_kwargs, hist) for alias, dist_class in candidates
+    )
+
+def _mean_log_likelihood(dist, data):
+    '''mean log likelihood of data in a fitted distribution'''
+    return np.mean(np.log(np.asarray(dist.pdf(data))))
+
 # Cell
 
 class RandomVariable():
     '''
     A container for distribution objects
+
+    when many candidate distributions are passed to fit:
+    - candidates are fitted concurrently by n_jobs workers (joblib) if n_jobs is not None
+    - log likelihoods are computed on a subsample of at most likelihood_sample_size points, shared by all candidates
+    - if racing, all candidates are first fitted on racing_frac of the data, and only those whose mean log likelihood
+    (per point) is at most racing_tolerance below the best one are fitted on the full data. requires calculate_likelihood
     '''
 
-    def __init__(self, default_dist = 'empirical', calculate_likelihood = False, verbose = False, keep_samples = False):
+    def __init__(self, default_dist = 'empirical', calculate_likelihood = False, verbose = False, keep_samples = False,
+                 n_jobs = None, likelihood_sample_size = None, racing = False, racing_frac = 0.1, racing_tolerance = 0.1):
+
+        if racing and not calculate_likelihood:
+            raise ValueError('racing requires calculate_likelihood = True')
+        assert 0 < racing_frac <= 1, 'racing_frac should be 0 < racing_frac <= 1'
         self._fitted_dists = {}
         self.log_likelihood = []
         self.default_dist = default_dist
@@ -416,6 +762,11 @@ class RandomVariable():
         self.keep_samples = keep_samples
         self._samples = None
         self.calculate_likelihood = calculate_likelihood
+        self.n_jobs = n_jobs
+        self.likelihood_sample_size = likelihood_sample_size
+        self.racing = racing
+        self.racing_frac = racing_frac
+        self.racing_tolerance = racing_tolerance
         return
 
     def _reset_fits(self,):
@@ -472,55 +823,54 @@ class RandomVariable():
 
         return
 
-    def _fit_all(self, data, dists, **fit_kwargs):
-        #TODO: check for multiplicity in candidates aliases
-        for candidate in ctqdm(dists, verbose = self.verbose):
-            self._fit_dist(data, candidate, **fit_kwargs)
-        return self
-
-    def _fit_dist(self, data, dist, **fit_kwargs):
+    def _resolve_candidate(self, dist):
         '''
-        fits a specified distribution through scipy.stats.rv_continuous.fit method
+        returns (alias, dist_class) of a candidate
         '''
         alias, dist_name = self._handle_dist_names(dist)
         alias, dist_class = self._get_dist_from_name(alias, dist_name)
         if alias.lower() == 'best':
             raise ValueError('"best" cannot be an alias for a distribution. its internally assgined to the best fit dist')
+        if not alias in ['kde','empirical','rv_histogram'] and self.n_dim > 1:
+            raise ValueError('rv_continuous distributions is only available for 1d distributions. Use "kde" dist instead.')
+        return alias, dist_class
 
-        if alias == 'rv_histogram':
-
-            hist = np.histogram(data, bins = 'auto')#len(np.unique(data)))
-            dist = dist_class(hist)
-            #make this step to optimize since log likelihiood estimation can be expensive
-            if self.calculate_likelihood:
-                log_likelihood = np.sum(np.log(dist.pdf(data)))
-            else:
-                log_likelihood = None
+    def _likelihood_sample(self, data):
+        '''
+        subsample of data shared by all candidates to compute log likelihoods
+        '''
+        if self.likelihood_sample_size is None or self.likelihood_sample_size >= data.shape[0]:
+            return data
+        return data[np.random.choice(data.shape[0], self.likelihood_sample_size, replace = False)]
 
-            self._fitted_dists = {**self._fitted_dists, **{alias:(dist,log_likelihood)}}
-            self.log_likelihood = list({**dict(self.log_likelihood), **{alias:log_likelihood}}.items())
+    def _fit_all(self, data, dists, **fit_kwargs):
+        #TODO: check for multiplicity in candidates aliases
+        candidates = [self._resolve_candidate(dist) for dist in dists]
+        if self.calculate_likelihood:
+            likelihood_data = self._likelihood_sample(data)
 
-        elif not alias in ['kde','empirical']:
-            if self.n_dim > 1:
-                raise ValueError('rv_continuous distributions is only available for 1d distributions. Use "kde" dist instead.')
-            params = dist_class.fit(data, **fit_kwargs)
-            #make this step to optimize since log likelihiood estimation can be expensive
-            if self.calculate_likelihood:
-                log_likelihood = np.sum(np.log(dist_class.pdf(data,*params)))
+        if self.racing and len(candidates) > 1:
+            #fit on a fraction of data and drop candidates clearly worse than the best
+            if fit_kwargs.get('sample_weight') is None:
+                partial_fits = _fit_candidates(draw_from(data, frac = self.racing_frac), candidates, fit_kwargs, self.n_jobs)
             else:
-                log_likelihood = None
-
-            self._fitted_dists = {**self._fitted_dists, **{alias:(dist_class(*params),log_likelihood)}}
-            self.log_likelihood = list({**dict(self.log_likelihood), **{alias:log_likelihood}}.items())
-        else:
-            #fit kws passed to constructor in sklearn fashion
-            dist = dist_class(**fit_kwargs).fit(data)
+                #subsample data and sample_weight with the same rows
+                rows = np.random.choice(data.shape[0], max(1, int(round(self.racing_frac*data.shape[0]))), replace = False)
+                race_kwargs = {**fit_kwargs, 'sample_weight':np.asarray(fit_kwargs['sample_weight'])[rows]}
+                partial_fits = _fit_candidates(data[rows], candidates, race_kwargs, self.n_jobs)
+            scores = np.array([_mean_log_likelihood(dist, likelihood_data) for dist in partial_fits])
+            scores = np.where(np.isnan(scores), -np.inf, scores)
+            candidates = [c for c, score in zip(candidates, scores) if score >= scores.max() - self.racing_tolerance]
+            if self.verbose:
+                print(f'racing kept {[alias for alias, _ in candidates]}')
+
+        fitted = _fit_candidates(data, candidates, fit_kwargs, self.n_jobs)
+        for (alias, _), dist in zip(ctqdm(candidates, verbose = self.verbose), fitted):
             #make this step to optimize since log likelihiood estimation can be expensive
             if self.calculate_likelihood:
-                log_likelihood = np.sum(np.log(dist.pdf(data)))
+                log_likelihood = _mean_log_likelihood(dist, likelihood_data)*data.shape[0]
             else:
                 log_likelihood = None
-
             self._fitted_dists = {**self._fitted_dists, **{alias:(dist,log_likelihood)}}
             self.log_likelihood = list({**dict(self.log_likelihood), **{alias:log_likelihood}}.items())
 
@@ -528,6 +878,12 @@ class RandomVariable():
         self._check_best()
         return self
 
+    def _fit_dist(self, data, dist, **fit_kwargs):
+        '''
+        fits a specified distribution through scipy.stats.rv_continuous.fit method
+        '''
+        return self._fit_all(data, [dist], **fit_kwargs)
+
 
     def _get_dist_from_name(self, alias, dist_name):
         '''
@@ -657,19 +1013,45 @@ class RandomVariable():
 # Cell
 #CREATE EMPIRICAL XXDIST CLASS (RV_HISTOGRAM IS TOO SLOW)
 
+def _call_elements(funcs, args, kwargs):
+    '''
+    calls each func with its (same position) args and kwargs. used to dispatch chunks of CustomArray calls to workers
+    '''
+    return [func(*arg, **kwarg) for func, arg, kwarg in zip(funcs, args, kwargs)]
+
 class CustomArray:
     '''
-    An array that contains RandomVariable objects and facilitates method calls and getting attributes
+    An array that contains RandomVariable objects and facilitates method calls and getting attributes.
+    method calls can be dispatched to a pool of n_jobs workers ("threads" or "processes" backend), in chunks of chunk_size elements.
+    the "processes" backend pickles each element to the workers and each result back, so it pays off only when the work
+    per element (such as fitting) is heavy compared to the size of the (fitted) element
     '''
 
-    def __init__(self, data):
-        ''' the constructor recieves a list of RandomVariable items'''
+    AVALIBLE_BACKENDS = ['serial', 'threads', 'processes']
+
+    def __init__(self, data, n_jobs = None, backend = None, chunk_size = 'auto'):
+        '''
+        the constructor recieves a list of RandomVariable items.
+        if backend is None, "serial" is used when n_jobs is None and "threads" otherwise.
+        if chunk_size == "auto", elements are split in 4 chunks per worker
+        '''
+        if backend is None:
+            backend = 'serial' if n_jobs is None else 'threads'
+        if not backend in self.AVALIBLE_BACKENDS:
+            raise ValueError(f'backend should be one of {self.AVALIBLE_BACKENDS}, not {backend}')
         self._data = np.array(data)
+        self.n_jobs = n_jobs
+        self.backend = backend
+        self.chunk_size = chunk_size
 
     @property
     def data(self,):
         return self._data
 
+    @property
+    def _parallel_kws(self,):
+        return dict(n_jobs = self.n_jobs, backend = self.backend, chunk_size = self.chunk_size)
+
     def __getattr__(self, attr):
         '''
         Custom __getattr__ method
@@ -678,10 +1060,44 @@ class CustomArray:
         for i in self.data:
             attr_list.append(getattr(i,attr))
         if all([callable(i) for i in attr_list]):
-            return CustomArray(attr_list)
+            return CustomArray(attr_list, **self._parallel_kws)
         else:
             return np.array(attr_list)
 
+    def _get_chunk_size(self, n_elements):
+        if self.chunk_size == 'auto':
+            return max(1, int(np.ceil(n_elements/(4*effective_n_jobs(self.n_jobs)))))
+        return self.chunk_size
+
+    def _dispatch(self, args, kwargs):
+        '''
+        calls each element with its args and kwargs (lists of the same length as self.data). returns a list of results, in order
+        '''
+        funcs = list(self.data)
+        if self.backend == 'serial' or effective_n_jobs(self.n_jobs) == 1:
+            return _call_elements(funcs, args, kwargs)
+
+        if self.backend == 'threads':
+            parallel = Parallel(n_jobs = self.n_jobs, **_joblib_parallel_args(prefer = 'threads'))
+        else:
+            parallel = Parallel(n_jobs = self.n_jobs, backend = 'loky')
+        chunks = chunk_slices(len(funcs), self._get_chunk_size(len(funcs)))
+        results = parallel(delayed(_call_elements)(funcs[chunk], args[chunk], kwargs[chunk]) for chunk in chunks)
+        return [result for chunk_results in results for result in chunk_results]
+
+    def _gather(self, results):
+        '''
+        stacks array results of same shape into a preallocated array, wraps other results in a CustomArray
+        '''
+        if not all([isinstance(i,np.ndarray) for i in results]):
+            return CustomArray(results, **self._parallel_kws)
+        if len(set(i.shape for i in results)) != 1:
+            return np.array(results)
+
+        output = np.empty((len(results), *results[0].shape), dtype = np.result_type(*results))
+        for i, result in enumerate(results):
+            output[i] = result
+        return output
 
     def __call__(self, *args, broadcast_method = 'simple', **kwargs):
         '''
@@ -690,77 +1106,32 @@ class CustomArray:
         broadcast: for each (row) object in RVArray, the correspondent (same row) arg and kwarg is applied
         '''
         assert broadcast_method in ['simple','broadcast']
+        n_elements = len(self.data)
 
         if broadcast_method == 'simple':
-            results = []
-            for i in self.data:
-                results.append(i(*args,**kwargs))
-
-            if all([isinstance(i,np.ndarray) for i in results]):
-                return np.array(results)
-            else:
-                return CustomArray(results)
-
-        elif broadcast_method == 'broadcast':
-
-            if args:
-                args_lens_check = [len(arg) == len(self.data) for arg in args]
-                assert all(args_lens_check)
-            if kwargs:
-                kwargs_lens_check = [len(arg) == len(self.data) for arg in kwargs.items()]
-                assert all(kwargs_lens_check)
-
-            #prepare args
-            if args:
-                _args = []
-                for arg in args:
-                    _args.append([val for val in arg])
-                args = _args
-            #prepare kwargs
-            _kwargs = []
-            if kwargs:
-                _len = len(kwargs[list(kwargs)[0]])
-                for i in range(_len):
-                    kwargs_i = {}
-                    for key in kwargs:
-                        kwargs_i[key] = kwargs[key][i]
-                    _kwargs.append(kwargs_i)
-                kwargs = _kwargs
-
-            #run
-            if kwargs and args:
-                results = []
-                for i in range(len(self.data)):
-                    results.append(self.data[i](*args[i],**kwargs[i]))
-
-            elif kwargs and not args:
-                results = []
-                for i in range(len(self.data)):
-                    results.append(self.data[i](*args,**kwargs[i]))
-
-            elif not kwargs and args:
-                results = []
-                for i in range(len(self.data)):
-                    results.append(self.data[i](*[arg[i] for arg in args],**kwargs))
-            else:
-                results = []
-                for i in range(len(self.data)):
-                    results.append(self.data[i](*args,**kwargs))
-
-            #return values
-            if all([isinstance(i,np.ndarray) for i in results]):
-                return np.array(results)
-            else:
-                return CustomArray(results)
-
+            results = self._dispatch(n_elements*[args], n_elements*[kwargs])
+            return self._gather(results)
+
+        if args:
+            args_lens_check = [len(arg) == n_elements for arg in args]
+            assert all(args_lens_check)
+        if kwargs:
+            kwargs_lens_check = [len(arg) == n_elements for arg in kwargs.values()]
+            assert all(kwargs_lens_check)
+
+        #one tuple of args and one dict of kwargs for each element
+        element_args = [tuple(arg[i] for arg in args) for i in range(n_elements)]
+        element_kwargs = [{key:kwargs[key][i] for key in kwargs} for i in range(n_elements)]
+        results = self._dispatch(element_args, element_kwargs)
+        return self._gather(results)
 
     def __getitem__(self, *args):
 
         if len(args) > 1:
-            return CustomArray(self.data[args])
+            return CustomArray(self.data[args], **self._parallel_kws)
         else:
             if args[0].__class__ == str:
-                return CustomArray([i[args[0]] for i in self.data])
+                return CustomArray([i[args[0]] for i in self.data], **self._parallel_kws)
             else:
                 return self.data[args]
 
@@ -781,11 +1152,12 @@ class RVArray(CustomArray):
     A container containing RandomVariable objects. it allows for easily assessing methods and attributes
     from multiple RandomVariable objects simultaneously.
     Since its used for assessing methods of already fitted distributions, the `fit` method is disabled
+    n_jobs, backend and chunk_size control the parallel dispatch of method calls, see CustomArray
     '''
-    def __init__(self, rv_objects):
+    def __init__(self, rv_objects, n_jobs = None, backend = None, chunk_size = 'auto'):
         #skip assertion allowing duck typing
         #assert all(isinstance(i, RandomVariable) for i in rv_objects), 'All rv_objects passed to cosntructor should be instances of skdensity.core.random_variavle.RandomVariable'
-        super().__init__(rv_objects)
+        super().__init__(rv_objects, n_jobs, backend, chunk_size)
         return
 
     def fit_new(self, data, dist = None, **dist_kwargs):
@@ -797,13 +1169,14 @@ class RVArray(CustomArray):
         data = np.array(data)
 
         #no broadcasting case
+        #objects fitted in other processes are copies, so keep the returned objects
         if len(data.shape) in (1,2):
-            super().__getattr__('fit_new')(data, dist, broadcast_method = 'simple',**dist_kwargs)
+            self._data = super().__getattr__('fit_new')(data, dist, broadcast_method = 'simple',**dist_kwargs).data
             return self
         #broadcasting case
         dist_kwargs = self._broadcastable_kwargs(dist_kwargs)
         dist = self._broadcastable_arg(dist)
-        super().__getattr__('fit_new')(data, dist, broadcast_method = 'broadcast',**dist_kwargs)
+        self._data = super().__getattr__('fit_new')(data, dist, broadcast_method = 'broadcast',**dist_kwargs).data
         return self
 
     def fit(self, data, dist = None, **dist_kwargs):
@@ -815,13 +1188,14 @@ class RVArray(CustomArray):
         data = np.array(data)
 
         #no broadcasting case
+        #objects fitted in other processes are copies, so keep the returned objects
         if len(data.shape) in (1,2):
-            super().__getattr__('fit')(data, dist, broadcast_method = 'simple',**dist_kwargs)
+            self._data = super().__getattr__('fit')(data, dist, broadcast_method = 'simple',**dist_kwargs).data
             return self
         #broadcasting case
         dist_kwargs = self._broadcastable_kwargs(dist_kwargs)
         dist = self._broadcastable_arg(dist)
-        super().__getattr__('fit')(data, dist, broadcast_method = 'broadcast',**dist_kwargs)
+        self._data = super().__getattr__('fit')(data, dist, broadcast_method = 'broadcast',**dist_kwargs).data
         return self
 
     def entropy(self, dist = 'best', **entropy_kws):
@@ -918,4 +1292,196 @@ class RVArray(CustomArray):
         '''
         Same as RandomVariable.sample
         '''
-        return super().__getattr__('sample')(sample_size, dist, broadcast_method = 'simple',**kwargs)
\ No newline at end of file
+        return super().__getattr__('sample')(sample_size, dist, broadcast_method = 'simple',**kwargs)
+# Cell
+class BatchRVArray():
+    '''
+    columnar alternative to RVArray. instead of an array of RandomVariable objects, the samples of all distributions
+    are stored in a single (n_dists, n_samples, n_dims) array, with optional (n_dists, n_samples) sample weights,
+    and every method is computed for all distributions at once.
+    dist can be "empirical" or "kde". pdf and entropy are always estimated through a BatchKDE fitted (lazily)
+    on the stacked samples, as Empirical does for each distribution.
+    '''
+
+    AVALIBLE_DISTS = ['empirical', 'kde']
+
+    def __init__(self, samples, weights = None, dist = 'empirical', bw = 'std_distance', batch_memory = 2**28):
+
+        if not dist in self.AVALIBLE_DISTS:
+            raise ValueError(f'dist should be one of {self.AVALIBLE_DISTS}, not {dist}')
+        samples = np.asarray(samples, dtype = float)
+        if len(samples.shape) == 2:
+            samples = _add_n_dims_axis(samples)
+        samples = _assert_dim_3d(samples)
+        if not weights is None:
+            weights = _assert_dim_2d(np.asarray(weights, dtype = float))
+            if weights.shape != samples.shape[:2]:
+                raise ValueError(f'weights should be of shape {samples.shape[:2]}, got {weights.shape} instead')
+            weights = normalize(weights, norm = 'l1')
+
+        self.samples = samples
+        self.weights = weights
+        self.dist = dist
+        self.bw = bw
+        self.batch_memory = batch_memory
+        self._kde = None
+        return
+
+    @property
+    def n_dim(self,):
+        return self.samples.shape[-1]
+
+    @property
+    def kde(self,):
+        '''BatchKDE fitted on the stacked samples'''
+        if self._kde is None:
+            self._kde = BatchKDE(bw = self.bw, batch_memory = self.batch_memory).fit(self.samples, sample_weight = self.weights)
+        return self._kde
+
+    def __len__(self,):
+        return self.samples.shape[0]
+
+    def __getitem__(self, item):
+        if isinstance(item, (int, np.integer)):
+            item = [item]
+        weights = None if self.weights is None else self.weights[item]
+        return BatchRVArray(self.samples[item], weights, self.dist, self.bw, self.batch_memory)
+
+    def __repr__(self):
+        return f'BatchRVArray(n_dists = {len(self)}, n_samples = {self.samples.shape[1]}, n_dims = {self.n_dim}, dist = {self.dist})'
+
+    def _check_points(self, data):
+        '''
+        1d or 2d data is evaluated in all distributions, 3d data should be of shape (n_dists, n_points, n_dims)
+        and each distribution is evaluated in its own (same row) points
+        '''
+        data = np.asarray(data, dtype = float)
+        if len(data.shape) == 1:
+            data = data.reshape(-1, self.n_dim)
+        if len(data.shape) == 2:
+            data = np.broadcast_to(data, (len(self), *data.shape))
+        data = _assert_dim_3d(data)
+        if data.shape[0] != len(self) or data.shape[-1] != self.n_dim:
+            raise ValueError(f'data should be of shape ({len(self)}, n_points, {self.n_dim}), got {data.shape} instead')
+        return data
+
+    def _check_percentiles(self, data):
+        data = np.asarray(data, dtype = float)
+        if len(data.shape) == 1:
+            data = np.broadcast_to(data, (len(self), data.shape[0]))
+        data = _assert_dim_2d(data)
+        if data.shape[0] != len(self):
+            raise ValueError(f'percentiles should be of shape ({len(self)}, n_percentiles), got {data.shape} instead')
+        if (data < 0).any() or (data > 1).any():
+            raise ValueError('percentiles should be in the interval [0,1]')
+        return data
+
+    def rvs(self, size = 1, random_state = None):
+        '''
+        returns array of shape (n_dists, size, n_dims)
+        '''
+        if self.dist == 'kde':
+            return self.kde.sample(size, random_state = random_state)
+        if self.weights is None:
+            idxs = check_random_generator(random_state).integers(0, self.samples.shape[1], size = (len(self), size))
+        else:
+            idxs = inverse_cdf_sample(self.weights, size, random_state = random_state)
+        return np.take_along_axis(self.samples, idxs[:,:,None], axis = 1)
+
+    def sample(self, sample_size = 1, random_state = None):
+        '''
+        alias for rvs
+        '''
+        return self.rvs(size = sample_size, random_state = random_state)
+
+    def pdf(self, data):
+        '''
+        returns array of shape (n_dists, n_points)
+        '''
+        return self.kde.evaluate(self._check_points(data))
+
+    def evaluate(self, data):
+        '''alias for self.pdf'''
+        return self.pdf(data)
+
+    def predict(self, data):
+        '''alias for self.pdf'''
+        return self.pdf(data)
+
+    def cdf(self, data):
+        '''
+        marginal cdf of data along each dim. returns array of shape (n_dists, n_points, n_dims)
+        '''
+        data = self._check_points(data)
+        if self.dist == 'kde':
+            return self.kde.cdf(data)
+        if self.weights is None:
+            return _empirical_quantile(data, self.samples)
+
+        n_dists, n_points, n_dims = data.shape
+        values = np.empty(data.shape)
+        for chunk in self.kde._chunks(n_dists, n_points*self.samples.shape[1]*n_dims):
+            less_equal = self.samples[chunk][:,None,:,:] <= data[chunk][:,:,None,:]
+            values[chunk] = np.einsum('nmsd,ns->nmd', less_equal, self.weights[chunk])
+        return values
+
+    def _sorted_samples_ppf(self, percentiles, samples, weights):
+        '''
+        marginal ppf of each dim, from samples and weights sorted along axis 1
+        '''
+        n_dists, n_samples, n_dims = samples.shape
+        n_percentiles = percentiles.shape[1]
+        if weights is None:
+            #same as np.quantile with linear interpolation
+            position = percentiles*(n_samples - 1)
+            lower = np.floor(position).astype(int)
+            upper = np.minimum(lower + 1, n_samples - 1)
+            frac = (position - lower)[:,:,None]
+            lower_values = np.take_along_axis(samples, lower[:,:,None], axis = 1)
+            upper_values = np.take_along_axis(samples, upper[:,:,None], axis = 1)
+            return lower_values + frac*(upper_values - lower_values)
+
+        #first sample whose cumulative weight reaches each percentile, with one row for each (dist, dim) pair
+        cum_weights = np.cumsum(weights, axis = 1).transpose(0,2,1).reshape(-1, n_samples)
+        cum_weights = cum_weights/cum_weights[:,-1:]
+        queries = np.broadcast_to(percentiles[:,None,:], (n_dists, n_dims, n_percentiles)).reshape(-1, n_percentiles)
+        #shift each row by its row number, so a single searchsorted can be performed in the flattened array
+        offsets = 2*np.arange(cum_weights.shape[0]).reshape(-1,1)
+        idxs = np.searchsorted((cum_weights + offsets).ravel(), (queries + offsets).ravel(), side = 'left')
+        idxs = np.clip(idxs.reshape(queries.shape) - offsets//2*n_samples, 0, n_samples - 1)
+        idxs = idxs.reshape(n_dists, n_dims, n_percentiles).transpose(0,2,1)
+        return np.take_along_axis(samples, idxs, axis = 1)
+
+    def ppf(self, data, inference_sample_size = 1000, random_state = None):
+        '''
+        marginal percent point function along each dim. data can be of shape (n_percentiles,) or (n_dists, n_percentiles)
+        returns array of shape (n_dists, n_percentiles, n_dims).
+        for dist = "kde", percentiles are taken from inference_sample_size samples of each distribution
+        '''
+        percentiles = self._check_percentiles(data)
+        if self.dist == 'kde':
+            samples, weights = self.kde.sample(inference_sample_size, random_state = random_state), None
+        else:
+            samples, weights = self.samples, self.weights
+
+        order = samples.argsort(axis = 1)
+        samples = np.take_along_axis(samples, order, axis = 1)
+        if not weights is None:
+            weights = np.take_along_axis(np.broadcast_to(weights[:,:,None], order.shape), order, axis = 1)
+        return self._sorted_samples_ppf(percentiles, samples, weights)
+
+    def entropy(self, sample_size = 100, random_state = None):
+        '''
+        monte carlo estimate of the entropy (in bits) of each distribution, shape (n_dists,)
+        '''
+        return self.kde.entropy(sample_size, random_state = random_state)
+
+    def to_rvarray(self, **dist_kws):
+        '''
+        returns the equivalent RVArray of RandomVariable objects. creates one object per distribution
+        '''
+        rv_objects = []
+        for i in range(len(self)):
+            fit_kws = dist_kws if self.weights is None else {**dist_kws, 'sample_weight':self.weights[i]}
+            rv_objects.append(RandomVariable(keep_samples = False).fit(self.samples[i], self.dist, **fit_kws))
+        return RVArray(rv_objects)
@@ -10,13 +10,15 @@ __all__ = ['QuantileCalibrator', 'identity_func', 'HistogramEstimator', 'IDENTIT
 from warnings import warn
 from functools import partial
 import copy
-from tqdm.notebook import tqdm
+import os
+import shutil
+import tempfile
+import weakref
 
 import numpy as np
-import pandas as pd
 from sklearn import ensemble
 from sklearn.base import BaseEstimator, ClassifierMixin
-from sklearn.preprocessing import OneHotEncoder, normalize, QuantileTransformer, FunctionTransformer, MinMaxScaler
+from sklearn.preprocessing import normalize, QuantileTransformer, FunctionTransformer, MinMaxScaler
 from sklearn.calibration import CalibratedClassifierCV
 from sklearn.multioutput import MultiOutputRegressor, MultiOutputClassifier
 from sklearn.utils.fixes import _joblib_parallel_args
@@ -30,16 +32,21 @@ from numpy.linalg import LinAlgError
 from scipy.spatial.distance import cdist
 
 import scipy
-from joblib import Parallel, delayed
+import joblib
+from joblib import Parallel, delayed, effective_n_jobs
 
 
 from .utils import (cos_sim_query, sample_multi_dim, ctqdm, add_noise,sample_from_dist_array,
                                   DelegateEstimatorMixIn, _fix_X_1d, _fix_one_dist_1d, _fix_one_dist_2d,
-                                  _add_n_dists_axis,_add_n_samples_axis,_add_n_dims_axis,sample_idxs, make_batches
+                                  _add_n_dists_axis,_add_n_samples_axis,_add_n_dims_axis,sample_idxs, make_batches,
+                                  inverse_cdf_sample, transform_query_space, transform_query_vector, InvertedIndex, LeafEncoder,
+                                  ChunkedPredictMixIn, cumulative_encode, tqdm, dump_csr, load_csr, dump_arrays, load_arrays,
+                                  check_random_generator
                                  )
 
-from .metrics import kde_entropy, quantile, marginal_variance, bimodal_variance, kde_likelihood, kde_quantile, agg_smallest_distance, cdf
-from .core.random_variable import KDE, RandomVariable, RVArray
+from .metrics import (kde_entropy, quantile, marginal_variance, bimodal_variance, kde_likelihood, kde_quantile, agg_smallest_distance, cdf,
+                      weighted_moments, weighted_quantile)
+from .core.random_variable import KDE, RandomVariable, RVArray, BatchRVArray
 
 # Cell
 class QuantileCalibrator(BaseEstimator):
@@ -72,13 +79,10 @@ class QuantileCalibrator(BaseEstimator):
         '''
         cdfs = cdf(X)
         cdfs = cdfs[:,:,0] #works only for 1d dists
-        weights = []
-        for dist in cdfs:
-            dg = np.digitize(dist, bins=np.linspace(0,1,self.bins-1, endpoint = False))
-            weights.append(self.q_dist[dg])
+        dg = np.digitize(cdfs, bins=np.linspace(0,1,self.bins-1, endpoint = False))
 
         #create weights as the bin count and then normalize
-        weights = normalize(np.array(weights), norm = 'l1')
+        weights = normalize(self.q_dist[dg], norm = 'l1')
         return weights
 
     def sample(self, X, sample_size = 1000, weight_func = None,
@@ -113,14 +117,16 @@ IDENTITY_TRANSFORMER = FunctionTransformer(
 )
 
 
-class HistogramEstimator(BaseEstimator, ClassifierMixin, DelegateEstimatorMixIn):
+class HistogramEstimator(BaseEstimator, ClassifierMixin, DelegateEstimatorMixIn, ChunkedPredictMixIn):
     '''
     Meanwhile only performs marginal density estiamtion, not joint. Thus, only 1dimensional y.
     For joint, should try something using RegressionChain (to pass dimension information to the prediction of other dims)
     '''
-    def __init__(self,estimator, resolution = 'auto' ,alpha = 1, calibrated_classifier = None, calibration_cv = 4,rv_bins_kws = {}):
+    def __init__(self,estimator, resolution = 'auto' ,alpha = 1, calibrated_classifier = None, calibration_cv = 4,rv_bins_kws = {},
+                 bin_pool_size = 1000):
         '''
         resolution can be int (number of bins of uniform quantile transformation) or hist array
+        bin_pool_size is the number of values sampled from each bin RandomVariable during fit, that are resampled when sampling
         '''
         self.cumulative_target = False #used only in ClassificationKernelEstimator thorugh inheritance
         assert hasattr(estimator, 'predict_proba') or ('predict_proba' in dir(estimator)), 'estimator should implement `predict_proba` method'
@@ -130,6 +136,7 @@ class HistogramEstimator(BaseEstimator, ClassifierMixin, DelegateEstimatorMixIn)
         assert isinstance(resolution, (np.ndarray, int, str)), f'resolution should be Array of bin edges, str or int, got {resolution.__class__}'
         self.resolution = resolution
         self.rv_bins_kws = rv_bins_kws
+        self.bin_pool_size = bin_pool_size
 
         self.calibration_cv = calibration_cv
         if calibrated_classifier == 'default':
@@ -195,12 +202,7 @@ class HistogramEstimator(BaseEstimator, ClassifierMixin, DelegateEstimatorMixIn)
                 max_bin = self.resolution
 
 
-            y_transformed = np.zeros((y.shape[0],max_bin), dtype = 'int8')
-            for i in range(len(y_transformed)):
-                bin_idx = int(hist_bins[i])
-                y_transformed[i, :bin_idx] = 1
-
-            y_transformed = y_transformed[:,:-1]
+            y_transformed = cumulative_encode(hist_bins, max_bin)
 
         else:
             if type(self.resolution) in (str, np.ndarray):
@@ -280,6 +282,7 @@ class HistogramEstimator(BaseEstimator, ClassifierMixin, DelegateEstimatorMixIn)
         bins_data_mapper = [y[y_transformed == i] for i in bin_ids]
         print('fitting RandomVariable for each bin')
         self._bin_dist_rvs = [RandomVariable(**self.rv_bins_kws).fit(d) for d in bins_data_mapper]
+        self._fit_bin_sample_pool()
 
         #fit calibrated classifier
         if not self.calibrated_classifier is None:
@@ -305,7 +308,8 @@ class HistogramEstimator(BaseEstimator, ClassifierMixin, DelegateEstimatorMixIn)
             probas = self.estimator.predict_proba(X)
             return np.array(probas)
 
-    def custom_predict(self, X, agg_func = np.mean, sample_size = 1000, weight_func = None, alpha = None, replace = True, noise_factor = 0):
+    def custom_predict(self, X, agg_func = np.mean, sample_size = 1000, weight_func = None, alpha = None, replace = True, noise_factor = 0,
+                       random_state = None):
         '''
         performs aggregation in a samples drawn for a specific X and returns the custom predicted value
         as the result of the aggregation. Could be mean, mode, median, std, entropy, likelihood...
@@ -313,36 +317,36 @@ class HistogramEstimator(BaseEstimator, ClassifierMixin, DelegateEstimatorMixIn)
         aggregation along dimensions, dont forget to tell agg_func to perform operations along axis = 0
         '''
 
-        samples = self.sample(X, sample_size, weight_func, alpha, replace, noise_factor)
+        samples = self.sample(X, sample_size, weight_func, alpha, replace, noise_factor, random_state)
         return np.array([agg_func(sample) for sample in samples])
 
 
-    def _rv_bin_sample(self, bin_probas, sample_size):
+    def _fit_bin_sample_pool(self):
         '''
-        Generate RV samples from bins of 1 observation
+        samples bin_pool_size values from each bin RandomVariable, stored as a (n_bins, bin_pool_size) array
         '''
-        assert len(bin_probas.shape) == 2, f'Passed weights array should be 2d not {bin_probas.shape}'
-        #SAMPLE ALL KDES AND THE SAMPLE FROM SAMPLED ARRAY
-        samples_dist = np.array([bin_dist.sample(sample_size) for bin_dist in self._bin_dist_rvs])
-
+        samples_dist = np.array([bin_dist.sample(self.bin_pool_size) for bin_dist in self._bin_dist_rvs])
         samples_dist = _add_n_dims_axis(samples_dist)
-        samples_dist = samples_dist[:,:,0]
-        idxs = sample_idxs(bin_probas, sample_size = sample_size)
-        samples = []
-        print('Sampling data from bins...')
-        for i in tqdm(np.arange(bin_probas.shape[0])):
-            idx = idxs[i]
-            idx, counts = np.unique(idx, return_counts = True)
-            s = [np.random.choice(samples_dist[i],c, replace = True) for i,c in zip(idx,counts)]
+        self._bin_sample_pool = samples_dist[:,:,0]
+        return self
 
-            samples.append(np.concatenate(s))
-        return np.array(samples)
+    def _rv_bin_sample(self, bin_probas, sample_size, random_state = None):
+        '''
+        Generate RV samples from bins of 1 observation.
+        two stage draw for all rows at once: bin ids from bin_probas, then values from the bin sample pool
+        '''
+        assert len(bin_probas.shape) == 2, f'Passed weights array should be 2d not {bin_probas.shape}'
+        if not hasattr(self, '_bin_sample_pool'):
+            self._fit_bin_sample_pool()
 
-    def sample(self, X, sample_size = 1000, weight_func = None, alpha = None, replace = True, noise_factor = 0):
+        rng = check_random_generator(random_state)
+        bin_idxs = sample_idxs(bin_probas, sample_size = sample_size, random_state = rng)
+        pool_idxs = rng.integers(0, self._bin_sample_pool.shape[1], size = bin_idxs.shape)
+        return self._bin_sample_pool[bin_idxs, pool_idxs]
+
+    def _sample_bin_probas(self, X, weight_func, alpha):
         '''
-        weight func is a function that takes weight array (n_dists, n_bins) and returned
-        an array of the same shape but with desired processing of the weights. if weight_func is not None,
-        alpha is ignored
+        returns the normalized bin probas (n_dists, n_bins) that sample draws bins from
         '''
         #set alpha if not None, else use self.alpha
         alpha = alpha if not alpha is None else self.alpha
@@ -356,21 +360,68 @@ class HistogramEstimator(BaseEstimator, ClassifierMixin, DelegateEstimatorMixIn)
         # for 1d case
         bins_probas = bins_probas[0,:,:]
         if not weight_func is None:
-            bins_probas = normalize(weight_func(bins_probas), norm  = 'l1')
+            return normalize(weight_func(bins_probas), norm  = 'l1')
         else:
-            bins_probas = normalize(bins_probas**alpha, norm = 'l1')
+            return normalize(bins_probas**alpha, norm = 'l1')
 
-        samples = self._rv_bin_sample(bins_probas, sample_size)
+    def sample(self, X, sample_size = 1000, weight_func = None, alpha = None, replace = True, noise_factor = 0, random_state = None):
+        '''
+        weight func is a function that takes weight array (n_dists, n_bins) and returned
+        an array of the same shape but with desired processing of the weights. if weight_func is not None,
+        alpha is ignored. random_state can be None, int, np.random.RandomState or np.random.Generator
+        '''
+        bins_probas = self._sample_bin_probas(X, weight_func, alpha)
+        rng = check_random_generator(random_state)
+        samples = self._rv_bin_sample(bins_probas, sample_size, random_state = rng)
         samples = _add_n_dims_axis(samples) # make a 3d sample array with dim axis = 1
         noise = agg_smallest_distance(samples, agg_func = np.std)
         noise = _add_n_dims_axis(noise)
-        return add_noise(samples, noise_factor*noise)
+        return add_noise(samples, noise_factor*noise, random_state = rng)
 
-    def density(self, X, dist = 'empirical', sample_size = 1000, weight_func = None, alpha = None, replace = True, noise_factor = 1e-7, **dist_kws):
+    def predict_moments(self, X, weight_func = None, alpha = None):
+        '''
+        returns the exact mean and variance (arrays of shape (n_dists, 1)) of the distribution that `sample` draws from
+        (without noise): a mixture of the bin sample pools, weighted by the bin probas. the variance follows the law of total variance
+        '''
+        bins_probas = self._sample_bin_probas(X, weight_func, alpha)
+        bin_means, bin_variances = self._bin_sample_pool.mean(axis = 1), self._bin_sample_pool.var(axis = 1)
+        mean = bins_probas @ bin_means
+        variance = bins_probas @ bin_variances + (bins_probas*(bin_means[None,:] - mean[:,None])**2).sum(axis = 1)
+        return mean.reshape(-1,1), variance.reshape(-1,1)
+
+    def predict_quantiles(self, X, q = [0.05, 0.5, 0.95], weight_func = None, alpha = None):
+        '''
+        returns the exact q quantiles (array of shape (n_dists, n_quantiles, 1)) of the distribution that `sample` draws from
+        (without noise). the inverse of the mixture cdf is found by bisection over the sorted values of all bin sample pools
+        '''
+        bins_probas = self._sample_bin_probas(X, weight_func, alpha)
+        q = np.atleast_1d(q).astype(float)
+        assert ((q >= 0) & (q <= 1)).all(), 'q values should be in the [0,1] interval'
+
+        sorted_pools = np.sort(self._bin_sample_pool, axis = 1)
+        pool_values = np.sort(sorted_pools.ravel())
+        def mixture_cdf(values):
+            bin_cdfs = [np.searchsorted(pool, values, side = 'right') for pool in sorted_pools]
+            return np.einsum('db,bdq->dq', bins_probas, np.array(bin_cdfs))/sorted_pools.shape[1]
+
+        #smallest pool value where the mixture cdf reaches q, for all rows and quantiles at once
+        lower = np.zeros((len(bins_probas), len(q)), dtype = int)
+        upper = np.full(lower.shape, len(pool_values) - 1)
+        while (lower < upper).any():
+            middle = (lower + upper)//2
+            reached = mixture_cdf(pool_values[middle]) >= q[None,:] - 1e-12
+            upper, lower = np.where(reached, middle, upper), np.where(reached, lower, middle + 1)
+        return pool_values[lower][:,:,None]
+
+    def density(self, X, dist = 'empirical', sample_size = 1000, weight_func = None, alpha = None, replace = True, noise_factor = 1e-7,
+                columnar = False, random_state = None, **dist_kws):
         '''
         returns a RVArray instance of RandomVariable objects fitted on sampled data based on X and other sample params
+        if columnar, returns a BatchRVArray of the sampled data instead
         '''
-        samples = self.sample(X, sample_size, weight_func, alpha, replace, noise_factor)
+        samples = self.sample(X, sample_size, weight_func, alpha, replace, noise_factor, random_state)
+        if columnar:
+            return BatchRVArray(samples, dist = dist, **dist_kws)
 
         print('Fitting random variable objects for each dsitribution...')
         rv_objects = [RandomVariable(keep_samples = False).fit(sample, dist, **dist_kws) for sample in tqdm(samples)]
@@ -504,13 +555,10 @@ class ClassificationKernelEstimator(HistogramEstimator):
 
         return np.array(samples)
 
-    def sample(self, X, sample_size=1000, n_neighbors=None,
-                alpha=None, noise_factor=None):
-
-        #handle args:
-        n_neighbors, alpha, noise_factor = self._handle_similarity_sample_parameters(
-            n_neighbors = n_neighbors, alpha = alpha, noise_factor = noise_factor)
-
+    def _sample_idx_and_sim(self, X, n_neighbors, alpha):
+        '''
+        returns the neighbor indexes and the (alpha powered) weights that sample draws neighbors from
+        '''
         #get probas
         probas = self.estimator.predict_proba(X)
         if isinstance(probas, list):
@@ -519,17 +567,39 @@ class ClassificationKernelEstimator(HistogramEstimator):
 
         # get idx and sim using proba vector as query vector
         idx, sim  = self._query_idx_and_sim(probas, n_neighbors)
-
-        # sample indexes and data, add noise
         if not alpha is None:
             sim = normalize(sim**alpha, norm = 'l1')
+        return idx, sim
 
+    def sample(self, X, sample_size=1000, n_neighbors=None,
+                alpha=None, noise_factor=None):
+
+        #handle args:
+        n_neighbors, alpha, noise_factor = self._handle_similarity_sample_parameters(
+            n_neighbors = n_neighbors, alpha = alpha, noise_factor = noise_factor)
+
+        # sample indexes and data, add noise
+        idx, sim = self._sample_idx_and_sim(X, n_neighbors, alpha)
         return self._sample_from_idx_sim(idx, sim, sample_size, noise_factor)
 
+    def predict_moments(self, X, n_neighbors=None, alpha=None):
+        '''returns the exact mean and variance (arrays of shape (n_dists, n_dims)) of the distribution that `sample` draws from (without noise)'''
+        n_neighbors, alpha = self._handle_similarity_sample_parameters(n_neighbors = n_neighbors, alpha = alpha)
+        idx, sim = self._sample_idx_and_sim(X, n_neighbors, alpha)
+        return weighted_moments(_fix_X_1d(self.y_)[idx], sim)
+
+    def predict_quantiles(self, X, q=[0.05, 0.5, 0.95], n_neighbors=None, alpha=None):
+        '''returns the exact q quantiles (array of shape (n_dists, n_quantiles, n_dims)) of the distribution that `sample` draws from (without noise)'''
+        n_neighbors, alpha = self._handle_similarity_sample_parameters(n_neighbors = n_neighbors, alpha = alpha)
+        idx, sim = self._sample_idx_and_sim(X, n_neighbors, alpha)
+        return weighted_quantile(_fix_X_1d(self.y_)[idx], sim, q)
+
     def density(self, X, dist = 'empirical', sample_size=1000, n_neighbors=None,
-                alpha=None, noise_factor=None, **dist_kws):
+                alpha=None, noise_factor=None, columnar=False, **dist_kws):
 
         samples = self.sample(X, sample_size, n_neighbors, alpha, noise_factor)
+        if columnar:
+            return BatchRVArray(samples, dist = dist, **dist_kws)
         print('fitting distribution objects...')
         rv_objects = [RandomVariable(keep_samples = False).fit(sample, dist, **dist_kws) for sample in tqdm(samples)]
         return RVArray(rv_objects)
@@ -589,6 +659,56 @@ AVALIBLE_DATAPOINT_WEIGHT_FUNC = {
     'gaussian_likelihood': datapoint_gaussian_likelihood
 }
 
+#closed form versions of node quality functions, applied to all nodes at once.
+#node data is passed as y values sorted by node (y_sorted) and the node boundaries (indptr), as in csc matrices
+def _segment_sum(values, indptr):
+    '''sums values in each [indptr[i], indptr[i+1]) segment using np.add.reduceat. empty segments sum to 0'''
+    sizes = np.diff(indptr)
+    sums = np.zeros((len(sizes), *values.shape[1:]))
+    nonempty = sizes > 0
+    if nonempty.any():
+        sums[nonempty] = np.add.reduceat(values, indptr[:-1][nonempty], axis = 0)
+    return sums
+
+def _segment_centroid_distances(y_sorted, indptr):
+    '''
+    standardized euclidean distance (as cdist(node_data, centroid, 'seuclidean')) of each point to its node centroid
+    '''
+    sizes = np.diff(indptr)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        centroids = _segment_sum(y_sorted, indptr)/sizes[:,None]
+        deviations = y_sorted - np.repeat(centroids, sizes, axis = 0)
+        #seuclidean variance is computed over node data and the centroid, which equals the biased node variance
+        variances = _segment_sum(deviations**2, indptr)/sizes[:,None]
+        return np.sqrt((deviations**2/np.repeat(variances, sizes, axis = 0)).sum(axis = 1))
+
+def _segment_inverese_log_node_var(y_sorted, indptr):
+    sizes = np.diff(indptr)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        mean_distances = _segment_sum(_segment_centroid_distances(y_sorted, indptr), indptr)/sizes
+        return 1/np.log1p(mean_distances)
+
+def _segment_datapoint_gaussian_likelihood(y_sorted, indptr):
+    sizes = np.diff(indptr)
+    distances = _segment_centroid_distances(y_sorted, indptr)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        distance_mean = _segment_sum(distances, indptr)/sizes
+        distance_std = np.sqrt(_segment_sum((distances - np.repeat(distance_mean, sizes))**2, indptr)/sizes)
+        distance_mean, distance_std = np.repeat(distance_mean, sizes), np.repeat(distance_std, sizes)
+        z = (distances - distance_mean)/distance_std
+        return 1/(distance_std*np.pi**(1/2))*np.exp(-1/2*z**2)
+
+_SEGMENT_NODE_AGG_FUNC = {
+    inverese_log_node_var: _segment_inverese_log_node_var,
+}
+
+_SEGMENT_DATAPOINT_WEIGHT_FUNC = {
+    datapoint_gaussian_likelihood: _segment_datapoint_gaussian_likelihood,
+}
+
+def _apply_to_batch(func, batch):
+    return [func(node_data) for node_data in batch]
+
 # Cell
 class TreeEstimatorMixin():
 
@@ -596,18 +716,75 @@ class TreeEstimatorMixin():
 
     @property
     def _node_data_generator(self):
-        return self._make_node_data_generator(self.y_, self._raw_leaf_node_matrix)
+        '''
+        generator of the y values of each leaf (zero copy views of _leaf_sorted_y)
+        '''
+        return (self._leaf_data(i) for i in range(len(self._leaf_offsets) - 1))
+
+    def _fit_leaf_segments(self, y, node_matrix):
+        '''
+        builds the leaf membership structure of node_matrix:
+        _leaf_permutation: data rows grouped by leaf (csc order of node_matrix)
+        _leaf_offsets: boundaries of each leaf in _leaf_permutation (csc indptr)
+        _leaf_sorted_y: y[_leaf_permutation], stored contiguously
+        '''
+        node_matrix = scipy.sparse.csc_matrix(node_matrix)
+        y = self._storage_array(y)
+        self._leaf_permutation = node_matrix.indices
+        self._leaf_offsets = node_matrix.indptr
+        self._leaf_sorted_y = np.ascontiguousarray(y.reshape(y.shape[0], -1)[self._leaf_permutation])
+        return self
+
+    def _append_leaf_segments(self, y, node_matrix, n_rows):
+        '''
+        merges the rows of node_matrix (new rows, numbered from n_rows on) and their y values into the leaf membership
+        structure. new rows go to the end of each leaf segment, so the result is the same as _fit_leaf_segments
+        on the stacked matrices, without sorting the current rows again
+        '''
+        node_matrix = scipy.sparse.csc_matrix(node_matrix)
+        y = self._storage_array(y)
+        y = y.reshape(y.shape[0], -1)
+        old_sizes, new_sizes = np.diff(self._leaf_offsets), np.diff(node_matrix.indptr)
+        old_positions = np.arange(self._leaf_offsets[-1]) + np.repeat(node_matrix.indptr[:-1], old_sizes)
+        new_positions = np.arange(node_matrix.nnz) + np.repeat(self._leaf_offsets[1:], new_sizes)
+        offsets = self._leaf_offsets + node_matrix.indptr
+        permutation = np.empty(offsets[-1], dtype = self._leaf_permutation.dtype)
+        permutation[old_positions] = self._leaf_permutation
+        permutation[new_positions] = node_matrix.indices + n_rows
+        sorted_y = np.empty((offsets[-1], self._leaf_sorted_y.shape[1]), dtype = self._leaf_sorted_y.dtype)
+        sorted_y[old_positions] = self._leaf_sorted_y
+        sorted_y[new_positions] = y[node_matrix.indices]
+        self._leaf_permutation, self._leaf_offsets, self._leaf_sorted_y = permutation, offsets, sorted_y
+        return self
+
+    def _leaf_subset_positions(self, leaves):
+        '''
+        positions in _leaf_sorted_y of the data of leaves, and the boundaries of each leaf inside those positions
+        '''
+        starts = self._leaf_offsets[leaves]
+        sizes = self._leaf_offsets[leaves + 1] - starts
+        offsets = np.concatenate([[0], np.cumsum(sizes)])
+        return np.arange(offsets[-1]) + np.repeat(starts - offsets[:-1], sizes), offsets
+
+    def _storage_array(self, array):
+        '''
+        casts float arrays (such as y) to the storage dtype of the estimator. other arrays are returned as they are
+        '''
+        array = np.asarray(array)
+        if np.issubdtype(array.dtype, np.floating):
+            return array.astype(getattr(self, 'dtype', np.float64), copy = False)
+        return array
 
-    def _make_node_data_generator(self, y, node_matrix):
+    def _storage_matrix(self, matrix):
         '''
-        creates a generator from sparse matrix where each iter retrns a row
+        casts the data of a csr or csc matrix to the storage dtype of the estimator.
+        indices are left as they are, scipy already uses int32 whenever the matrix fits
         '''
-        s1 = node_matrix.sum(axis = 0).cumsum().A.astype(int).flatten()
-        s2 = np.concatenate([[0],s1[:-1]])
-        slices = [slice(i[0],i[1]) for i in zip(s2,s1)]
-        idxs = node_matrix.tocsc().indices
-        idxs = [idxs[s] for s in slices]
-        return (y[idx] for idx in idxs)
+        return matrix.astype(getattr(self, 'dtype', np.float64), copy = False)
+
+    def _leaf_data(self, leaf):
+        '''y values of a leaf, as a view of _leaf_sorted_y'''
+        return self._leaf_sorted_y[self._leaf_offsets[leaf]:self._leaf_offsets[leaf + 1]]
 
     def _make_node_kde_array(self): #<- since kde esitmation is the best approach, save kde fitted instances for each node
         #to make use of it during node and node_data wieght inference
@@ -633,7 +810,7 @@ class TreeEstimatorMixin():
 
         nodes_array = self._apply(X)
 
-        self._leaf_node_transformer = OneHotEncoder(handle_unknown = 'ignore')
+        self._leaf_node_transformer = LeafEncoder(dtype = getattr(self, 'dtype', np.float64))
 
         leaf_node_matrix = self._leaf_node_transformer.fit_transform(nodes_array)
         if max_nodes is None:
@@ -653,25 +830,260 @@ class TreeEstimatorMixin():
             self._keep_data_in_query = np.random.choice(np.arange(leaf_node_matrix.shape[0]), size = max_nodes, replace = False, p = sample_weight)
 
         leaf_node_matrix = leaf_node_matrix[self._keep_data_in_query, :]
-        leaf_node_matrix = leaf_node_matrix[:, self._keep_nodes_in_query]
+        leaf_node_matrix = self._storage_matrix(leaf_node_matrix[:, self._keep_nodes_in_query])
+        #if node_data_rank_func is None, _leaf_node_matrix is this same object, not a copy
         self._raw_leaf_node_matrix = leaf_node_matrix
-        #self._node_data_generator = self.#self._make_node_data_generator(y, leaf_node_matrix)
-        self._leaf_node_weights = self._calculate_node_weights(y, leaf_node_matrix, node_rank_func)
-        self._leaf_node_matrix = self._make_weighted_query_space(y, leaf_node_matrix, node_data_rank_func)# <- try making this a property
+        self._fit_leaf_segments(y, leaf_node_matrix)
+        self._leaf_node_weights = self._storage_array(self._calculate_node_weights(y, leaf_node_matrix, node_rank_func))
+        self._leaf_node_matrix = self._storage_matrix(
+            self._make_weighted_query_space(y, leaf_node_matrix, node_data_rank_func))# <- try making this a property
+        self._reset_query_caches()
+        return self
+
+    def _reset_query_caches(self):
+        '''resets cached query spaces and leaf indexes and precomputes the default one'''
+        self._clear_query_space_folders()
+        self._query_space_cache = {}
+        self._leaf_index_cache = {}
+        if self.query_engine == 'inverted_index':
+            self._get_leaf_index(self.gamma)
+        else:
+            self._get_query_space(self.gamma)
         return self
 
+    def _extend_query_caches(self, node_matrix):
+        '''
+        appends the rows of the weighted node_matrix to the cached leaf indexes of every gamma.
+        cached query spaces share their indices with the leaf segments, so they are rebuilt from the extended segments
+        (a copy of the data, as hstacking them would be). rows are normalized one by one, so the leaf indexes stay valid
+        '''
+        self._clear_query_space_folders()
+        for gamma in self._query_space_cache:
+            self._query_space_cache[gamma] = self._leaf_query_space(gamma)
+        for gamma, leaf_index in self._leaf_index_cache.items():
+            leaf_index.partial_fit(transform_query_space(node_matrix, gamma))
+        return self
+
+    def _update_node_weights(self, leaves, node_rank_func):
+        '''
+        recalculates the node weights of leaves only (the leaves reached by new observations)
+        '''
+        if node_rank_func is None:
+            return self._leaf_node_weights
+
+        if node_rank_func in _SEGMENT_NODE_AGG_FUNC:
+            positions, offsets = self._leaf_subset_positions(leaves)
+            weights = _SEGMENT_NODE_AGG_FUNC[node_rank_func](self._leaf_sorted_y[positions], offsets)
+        else:
+            weights = [node_rank_func(self._leaf_data(leaf)) for leaf in leaves]
+
+        node_weights = np.array(self._leaf_node_weights)
+        node_weights[leaves] = weights
+        return node_weights
+
+    def _update_weighted_query_space(self, node_matrix, leaves, node_data_rank_func):
+        '''
+        appends the rows of node_matrix to the weighted query space, recalculating the datapoint weights of leaves only.
+        the weights of the other leaves are kept from the current query space.
+        _raw_leaf_node_matrix and the leaf segments should already contain the new rows
+        '''
+        #csc data is in the order of _leaf_sorted_y
+        query_space = scipy.sparse.vstack([self._leaf_node_matrix, node_matrix], format = 'csr').tocsc()
+        positions, offsets = self._leaf_subset_positions(leaves)
+        if node_data_rank_func in _SEGMENT_DATAPOINT_WEIGHT_FUNC:
+            weights = _SEGMENT_DATAPOINT_WEIGHT_FUNC[node_data_rank_func](self._leaf_sorted_y[positions], offsets)
+        else:
+            weights = np.concatenate([np.asarray(node_data_rank_func(self._leaf_data(leaf))).flatten() for leaf in leaves])
+        query_space.data[positions] = self._raw_leaf_node_matrix.tocsc().data[positions]*weights
+        return self._with_csc_data(self._raw_leaf_node_matrix, query_space.data)
+
+    def _check_add_observations(self):
+        '''
+        raises ValueError for estimators whose state cannot be updated incrementally
+        '''
+        if not self.entropy_estimator_sampler is None:
+            raise ValueError('observations cannot be added to estimators with an entropy_estimator_sampler, since the sampler '
+                             'is fitted on all the data. refit the estimator with the new rows instead')
+        if not isinstance(self._keep_data_in_query, slice):
+            raise ValueError('observations cannot be added to leaf node matrices subsampled with max_data. '
+                             'refit the estimator with the new rows instead')
+        return self
+
+    def add_observations(self, X, y):
+        '''
+        adds new labelled rows to the fitted leaf index, keeping the trained trees. only the new rows go through _apply,
+        node weights and datapoint weights are recalculated only for the leaves reached by them, and cached query spaces
+        and leaf indexes are extended instead of rebuilt (unless node_data_rank_func is set, since the datapoint weights,
+        and so the normalized rows, of the reached leaves change).
+        raises ValueError, before any change, for estimators with an entropy_estimator_sampler or fitted with max_data
+        '''
+        self._check_add_observations()
+
+        y = self._storage_array(y)
+        y = y.reshape(-1, *np.shape(self.y_)[1:])
+        assert X.shape[0] == y.shape[0], f'X and y should have the same number of rows. got {X.shape[0]} and {y.shape[0]}'
+
+        node_matrix = self._leaf_node_transformer.transform(self._apply(X))
+        node_matrix = self._storage_matrix(node_matrix[:, self._keep_nodes_in_query])
+        leaves = np.unique(node_matrix.indices)
+
+        self._append_leaf_segments(y, node_matrix, self._raw_leaf_node_matrix.shape[0])
+        raw_leaf_node_matrix = self._storage_matrix(
+            scipy.sparse.vstack([self._raw_leaf_node_matrix, node_matrix], format = 'csr'))
+        self._raw_leaf_node_matrix = raw_leaf_node_matrix
+        self.y_ = np.concatenate([self.y_, y])
+        self._leaf_node_weights = self._storage_array(self._update_node_weights(leaves, self.node_rank_func))
+
+        if self.node_data_rank_func is None:
+            self._leaf_node_matrix = raw_leaf_node_matrix
+            self._extend_query_caches(node_matrix)
+        else:
+            self._leaf_node_matrix = self._storage_matrix(
+                self._update_weighted_query_space(node_matrix, leaves, self.node_data_rank_func))
+            self._reset_query_caches()
+        return self
+
+    def _get_query_space(self, gamma):
+        '''
+        returns the gamma transformed, normalized and transposed _leaf_node_matrix.
+        results are cached by gamma, so the (large) query space is transformed only once
+        '''
+        if not hasattr(self, '_query_space_cache'):
+            self._query_space_cache = {}
+        if not gamma in self._query_space_cache:
+            self._query_space_cache[gamma] = self._leaf_query_space(gamma)
+        return self._query_space_cache[gamma]
+
+    def _leaf_query_space(self, gamma):
+        '''
+        same as transform_query_space(self._leaf_node_matrix, gamma), a (n_leaves, n_rows) csr matrix. its indices and indptr
+        are the leaf segments (_leaf_permutation and _leaf_offsets) themselves, so only the data array is allocated
+        '''
+        def normalize_rows(data):
+            #l2 norm of each row, zero norms are left as they are (as in sklearn normalize)
+            norms = np.sqrt(np.bincount(self._leaf_permutation, weights = data**2, minlength = self._leaf_node_matrix.shape[0]))
+            return data/np.where(norms == 0, 1, norms)[self._leaf_permutation]
+
+        #csc data is in the order of the leaf segments
+        data = self._leaf_node_matrix.tocsc().data.astype(float)
+        #as in _stretch_and_normalize, the power is applied to the normalized rows
+        if gamma != 1:
+            data = normalize_rows(data)**gamma
+        data = normalize_rows(data)
+        return scipy.sparse.csr_matrix(
+            (data.astype(getattr(self, 'dtype', np.float64)), self._leaf_permutation, self._leaf_offsets),
+            shape = self._leaf_node_matrix.shape[::-1], copy = False)
+
+    def _get_query_space_folder(self, gamma):
+        '''
+        returns (folder, name) of the csr buffers of the gamma query space, so the "processes" query backend can memory map it
+        in the workers instead of dumping it in every query. the query space is dumped once to a temporary folder, removed
+        when the query space changes or the estimator is garbage collected. estimators loaded with load use the saved buffers
+        '''
+        if gamma in self.__dict__.setdefault('_query_space_folder_cache', {}):
+            folder, name, temporary = self._query_space_folder_cache[gamma]
+            #a copy of the estimator may outlive the temporary folder of the original one
+            if os.path.exists(os.path.join(folder, f'{name}_data.npy')):
+                return folder, name
+        folder = tempfile.mkdtemp(prefix = 'skdensity_query_space_')
+        weakref.finalize(self, shutil.rmtree, folder, ignore_errors = True)
+        dump_csr(self._get_query_space(gamma), folder, 'query_space')
+        self._query_space_folder_cache[gamma] = (folder, 'query_space', True)
+        return folder, 'query_space'
+
+    def _clear_query_space_folders(self):
+        '''removes the temporary query space folders, once the query spaces they hold are outdated'''
+        for folder, name, temporary in self.__dict__.get('_query_space_folder_cache', {}).values():
+            if temporary:
+                shutil.rmtree(folder, ignore_errors = True)
+        self._query_space_folder_cache = {}
+        return self
+
+    def _get_leaf_index(self, gamma):
+        '''
+        returns an InvertedIndex (leaf -> posting list of training rows) of the gamma transformed _leaf_node_matrix.
+        results are cached by gamma
+        '''
+        if not hasattr(self, '_leaf_index_cache'):
+            self._leaf_index_cache = {}
+        if not gamma in self._leaf_index_cache:
+            self._leaf_index_cache[gamma] = InvertedIndex().fit(transform_query_space(self._leaf_node_matrix, gamma))
+        return self._leaf_index_cache[gamma]
+
+    def save(self, folder):
+        '''
+        saves the fitted estimator to folder. leaf node matrices, y_, leaf segments, cached query spaces and leaf indexes
+        are written as flat .npy buffers that load can memory map. the remaining state (including the base estimator)
+        is saved with joblib
+        '''
+        state, manifest = dump_arrays(self.__dict__, folder)
+        query_spaces = {}
+        for i, (gamma, query_space) in enumerate(self.__dict__.get('_query_space_cache', {}).items()):
+            dump_csr(query_space, folder, f'_query_space_{i}')
+            query_spaces[i] = gamma
+        leaf_indexes = {}
+        for i, (gamma, leaf_index) in enumerate(self.__dict__.get('_leaf_index_cache', {}).items()):
+            index_state, index_manifest = dump_arrays(leaf_index.__dict__, folder, prefix = f'_leaf_index_{i}_')
+            leaf_indexes[i] = (gamma, index_state, index_manifest)
+        state['_query_space_cache'], state['_leaf_index_cache'], state['_query_space_folder_cache'] = {}, {}, {}
+        artifact = {'class':self.__class__, 'state':state, 'manifest':manifest, 'query_spaces':query_spaces, 'leaf_indexes':leaf_indexes}
+        joblib.dump(artifact, os.path.join(folder, 'estimator.joblib'))
+        return folder
+
+    @classmethod
+    def load(cls, folder, mmap_mode = 'r'):
+        '''
+        loads an estimator saved with save. buffers are memory mapped with mmap_mode, so processes loading the same folder
+        share one page cached copy. cached query spaces are mapped copy on write when mmap_mode == "r", since sparse_dot_topn
+        rejects read only buffers (pages are still shared while they are not written)
+        '''
+        artifact = joblib.load(os.path.join(folder, 'estimator.joblib'), mmap_mode = mmap_mode)
+        if not issubclass(artifact['class'], cls):
+            raise TypeError(f'{folder} contains a {artifact["class"].__name__}, not a {cls.__name__}')
+        estimator = artifact['class'].__new__(artifact['class'])
+        estimator.__dict__.update(load_arrays(artifact['state'], artifact['manifest'], folder, mmap_mode = mmap_mode))
+
+        query_space_mmap_mode = 'c' if mmap_mode == 'r' else mmap_mode
+        estimator.__dict__.setdefault('_query_space_folder_cache', {})
+        for i, gamma in artifact['query_spaces'].items():
+            estimator._query_space_cache[gamma] = load_csr(folder, f'_query_space_{i}', mmap_mode = query_space_mmap_mode)
+            estimator._query_space_folder_cache[gamma] = (folder, f'_query_space_{i}', False)
+        for i, (gamma, index_state, index_manifest) in artifact['leaf_indexes'].items():
+            leaf_index = InvertedIndex.__new__(InvertedIndex)
+            leaf_index.__dict__.update(load_arrays(index_state, index_manifest, folder, f'_leaf_index_{i}_', mmap_mode))
+            estimator._leaf_index_cache[gamma] = leaf_index
+        return estimator
+
+    def _query_neighbors(self, X, n_neighbors, lower_bound, beta, gamma):
+        '''
+        queries the neighbors of X in the training data using the engine defined in self.query_engine
+        '''
+        if self.query_engine == 'inverted_index':
+            return self._get_leaf_index(gamma).query(
+                transform_query_vector(self._transform_query_matrix(X), beta), n_neighbors=n_neighbors, lower_bound=lower_bound)
+        elif self.query_backend == 'processes':
+            query_space_folder, query_space_name = self._get_query_space_folder(gamma)
+            return cos_sim_query(
+                self._transform_query_matrix(X), self._get_query_space(gamma), n_neighbors=n_neighbors,
+                lower_bound=lower_bound, beta = beta, query_space_is_transformed = True,
+                n_jobs = self.n_jobs, backend = self.query_backend,
+                query_space_folder = query_space_folder, query_space_name = query_space_name)
+        else:
+            return cos_sim_query(
+                self._transform_query_matrix(X), self._get_query_space(gamma), n_neighbors=n_neighbors,
+                lower_bound=lower_bound, beta = beta, query_space_is_transformed = True,
+                n_jobs = self.n_jobs, backend = self.query_backend)
+
     def _transform_query_matrix(self, X):
         node_matrix = self._leaf_node_transformer.transform(self._apply(X))
         node_matrix = node_matrix[:, self._keep_nodes_in_query]
-        return self._make_weighted_query_vector(
+        return self._storage_matrix(self._make_weighted_query_vector(
             agg_node_weights = self._leaf_node_weights,
-            node_matrix = node_matrix)
+            node_matrix = node_matrix))
 
 
     def _query_idx_and_sim(self, X, n_neighbors, lower_bound, beta, gamma):
-        idx, sim = cos_sim_query(
-            self._transform_query_matrix(X), self._leaf_node_matrix, n_neighbors=n_neighbors,
-            lower_bound=lower_bound, beta = beta, gamma = gamma)
+        idx, sim = self._query_neighbors(X, n_neighbors=n_neighbors, lower_bound=lower_bound, beta = beta, gamma = gamma)
         return idx, sim + 1e-9 #ensure sim vector is not null
 
 
@@ -691,7 +1103,7 @@ class TreeEstimatorMixin():
         Works only for marginal distributions
         '''
         nodes_array = self._apply(X)
-        self._leaf_node_transformer = OneHotEncoder()
+        self._leaf_node_transformer = LeafEncoder(dtype = getattr(self, 'dtype', np.float64))
         forest_embeddings = self._leaf_node_transformer.fit_transform(nodes_array)
         self.entropy_estimator_sampler.fit(forest_embeddings, y, **fit_kws)
         return self
@@ -703,16 +1115,8 @@ class TreeEstimatorMixin():
         idx, sim = np.array(idx), np.array(sim)
 
         p = self._handle_sample_weights(weight_func = weight_func, sim = sim, alpha = alpha)
-        samples = []
-        for i in np.arange(len(idx)):
-            ys = self.y_[sample_multi_dim(idx[i], sample_size = sample_size, weights = p[i], axis = 0)]
-            if len(ys.shape) == 1:
-                ys = ys.reshape(-1,1)
-            noise = agg_smallest_distance(ys.reshape(1,*ys.shape), agg_func = np.std)
-            ys = add_noise(ys, noise_factor*noise)
-            samples.append(RandomVariable(**rv_kwargs).fit(ys, sample_weight = None).sample(sample_size = sample_size))
-
-
+        ys = self._sample_from_idx_and_p(idx, p, sample_size, noise_factor)
+        samples = [RandomVariable(**rv_kwargs).fit(y, sample_weight = None).sample(sample_size = sample_size) for y in ys]
         return np.array(samples)
 
     def _similarity_sample(self, X, sample_size, weights, n_neighbors,
@@ -723,24 +1127,34 @@ class TreeEstimatorMixin():
         idx, sim = np.array(idx), np.array(sim)
 
         p = self._handle_sample_weights(weight_func = weights, sim = sim, alpha = alpha)
-        samples = []
-        for i in np.arange(len(idx)):
-            ys = self.y_[sample_multi_dim(idx[i], sample_size = sample_size, weights = p[i], axis = 0)]
-            if len(ys.shape) == 1:
-                ys = ys.reshape(-1,1)
-            noise = agg_smallest_distance(ys.reshape(1,*ys.shape), agg_func = np.std)
-            ys = add_noise(ys, noise_factor*noise)
-            samples.append(ys)
+        return self._sample_from_idx_and_p(idx, p, sample_size, noise_factor)
 
-        return np.array(samples)
+    def _sample_from_idx_and_p(self, idx, p, sample_size, noise_factor):
+        '''
+        batched sampling engine. draws sample_size neighbors for all rows at once through inverse cdf lookup in p
+        and gathers their values from self.y_.
+        idx and p should be of shape (n_dists, n_neighbors). returns array of shape (n_dists, sample_size, n_dims)
+        '''
+        sampled_cols = inverse_cdf_sample(p, sample_size)
+        sampled_idxs = np.take_along_axis(idx, sampled_cols, axis = 1)
+        y = self.y_ if len(self.y_.shape) > 1 else self.y_.reshape(-1,1)
+        samples = y[sampled_idxs]
+        if abs(noise_factor) > 0:
+            #noise scale of each dist and dim, shape (n_dists, 1, n_dims)
+            noise = _add_n_samples_axis(agg_smallest_distance(samples, agg_func = np.std))
+            samples = add_noise(samples, noise_factor*noise)
+        return samples
 
     def _density(self, X, dist, sample_size, weights, n_neighbors,
-                           lower_bound, alpha, beta, gamma, noise_factor, **dist_kws):
+                           lower_bound, alpha, beta, gamma, noise_factor, columnar = False, **dist_kws):
         '''
         returns a RVArray instance of RandomVariable objects fitted on sampled data based on X and other sample params
+        if columnar, returns a BatchRVArray of the sampled data instead
         '''
         samples = self._similarity_sample(X, sample_size, weights, n_neighbors,
                            lower_bound, alpha, beta, gamma, noise_factor)
+        if columnar:
+            return BatchRVArray(samples, dist = dist, **dist_kws)
 
         rv_objects = [RandomVariable(keep_samples = False).fit(sample, dist, **dist_kws) for sample in tqdm(samples)]
         return RVArray(rv_objects)
@@ -757,17 +1171,33 @@ class TreeEstimatorMixin():
         samples_idxs = samples_idxs.reshape(samples_idxs.shape[:-1])
         return samples_idxs
 
-    def _similarity_empirical_pdf(self, X, weights, n_neighbors, lower_bound, alpha, beta, gamma):
+    def _similarity_empirical_idx_and_p(self, X, weights, n_neighbors, lower_bound, alpha, beta, gamma):
 
-        idx, sim = cos_sim_query(
-            self._transform_query_matrix(X),
-            self._leaf_node_matrix,
-            n_neighbors=n_neighbors,
-            lower_bound=lower_bound,
-            beta = beta,
-            gamma = gamma)
+        idx, sim = self._query_neighbors(X, n_neighbors=n_neighbors, lower_bound=lower_bound, beta = beta, gamma = gamma)
         p = self._handle_sample_weights(weight_func = weights, sim = sim, alpha = alpha)
-        return np.array([self.y_[i] for i in idx]), p
+        return np.asarray(idx), p
+
+    def _similarity_empirical_pdf(self, X, weights, n_neighbors, lower_bound, alpha, beta, gamma):
+
+        idx, p = self._similarity_empirical_idx_and_p(X, weights, n_neighbors, lower_bound, alpha, beta, gamma)
+        y = self.y_ if len(self.y_.shape) > 1 else self.y_.reshape(-1,1)
+        return y[idx], p
+
+    def _predict_moments(self, X, weights, n_neighbors, lower_bound, alpha, beta, gamma):
+        '''
+        exact mean and variance of the neighbor weighted empirical distribution of each row in X, no sampling involved.
+        returns mean and variance arrays of shape (n_dists, n_dims)
+        '''
+        values, p = self._similarity_empirical_pdf(X, weights, n_neighbors, lower_bound, alpha, beta, gamma)
+        return weighted_moments(values, p)
+
+    def _predict_quantiles(self, X, q, weights, n_neighbors, lower_bound, alpha, beta, gamma):
+        '''
+        exact quantiles of the neighbor weighted empirical distribution of each row in X, no sampling involved.
+        returns array of shape (n_dists, n_quantiles, n_dims)
+        '''
+        values, p = self._similarity_empirical_pdf(X, weights, n_neighbors, lower_bound, alpha, beta, gamma)
+        return weighted_quantile(values, p, q)
 
     def _custom_predict(self, X, agg_func, sample_size, weights, n_neighbors, lower_bound, alpha, beta, gamma, noise_factor):
         '''
@@ -780,20 +1210,33 @@ class TreeEstimatorMixin():
         samples = self._similarity_sample(X, sample_size, weights, n_neighbors, lower_bound, alpha, beta, gamma, noise_factor)
         return np.array([agg_func(sample) for sample in samples])
 
+    def _map_nodes(self, func):
+        '''
+        applies func to the data of each node. if self.n_jobs allows, nodes are split in chunked batches
+        and processed in a process pool
+        '''
+        nodes = list(self._node_data_generator)
+        n_workers = effective_n_jobs(getattr(self, 'n_jobs', None))
+        if n_workers == 1 or len(nodes) < 2*n_workers:
+            return [func(node_data) for node_data in nodes]
+        batches = np.array_split(np.arange(len(nodes)), 4*n_workers)
+        results = Parallel(n_jobs = n_workers, backend = 'loky')(
+            delayed(_apply_to_batch)(func, [nodes[i] for i in batch]) for batch in batches)
+        return [result for batch_results in results for result in batch_results]
+
     def _calculate_node_weights(self, y, node_matrix, node_rank_func):
         '''
         calculates node weights that maultiplies the query space matrix, in order to make some nodes more relevant
         according to some target data node agg metric.
-        input should be a list containing array of node samples as each one of its elements
+        built in rank functions with closed form versions are computed for all nodes at once through segment reductions,
+        other callables are applied node by node (in parallel if self.n_jobs allows)
         '''
 
         if not node_rank_func is None:
-            # cannot call in a vectorized fashion because data from nodes may have different sizes
-            #node_weights = Parallel(n_jobs=-1, verbose=0,
-            #                   **_joblib_parallel_args(prefer="threads"))(
-            #    delayed(node_rank_func)(X)
-            #    for X in self._node_data_generator)
-            node_weights = [node_rank_func(X) for X in self._node_data_generator]
+            if node_rank_func in _SEGMENT_NODE_AGG_FUNC:
+                node_weights = _SEGMENT_NODE_AGG_FUNC[node_rank_func](self._leaf_sorted_y, self._leaf_offsets)
+            else:
+                node_weights = self._map_nodes(node_rank_func)
 
         else:
             node_weights = np.ones(node_matrix.shape[1])
@@ -804,22 +1247,21 @@ class TreeEstimatorMixin():
         '''
         Calculates node-datapoint(y values) weights. higher values meansa datapoint "belongs tighter"
         to that point and is more loleky to be sampled when that node is reached. some cases of node-datapount wieghts
-        could be the likelihood of that point given the node pdf, or some sort of median/mean deviance from point to node samples
+        could be the likelihood of that point given the node pdf, or some sort of median/mean deviance from point to node samples.
+        returns a flat array of weights in csc order of node_matrix (the order of _leaf_sorted_y)
         '''
-        #datapoint_node_weights = Parallel(n_jobs=1, verbose=0,
-        #                   **_joblib_parallel_args(prefer="threads"))(
-        #    delayed(node_data_rank_func)(X)
-        #    for X in node_data_generator)
+        if node_data_rank_func in _SEGMENT_DATAPOINT_WEIGHT_FUNC:
+            return _SEGMENT_DATAPOINT_WEIGHT_FUNC[node_data_rank_func](self._leaf_sorted_y, self._leaf_offsets)
 
-        datapoint_node_weights = [node_data_rank_func(node_data) for node_data in self._node_data_generator]
-        return datapoint_node_weights
+        datapoint_node_weights = self._map_nodes(node_data_rank_func)
+        return np.concatenate([np.asarray(weights).flatten() for weights in datapoint_node_weights])
 
     def _handle_sample_weights(self, weight_func, sim, alpha):
         '''
         sampling wights should sum to 1, since its a sampling probability
         '''
         if weight_func is None:
-            return np.array([normalize((i**alpha).reshape(1,-1), norm = 'l1').flatten() for i in sim])
+            return normalize(np.asarray(sim)**alpha, norm = 'l1')
         else:
             return np.array([normalize((weight_func(i)).reshape(1,-1), norm = 'l1').flatten() for i in sim])
 
@@ -844,28 +1286,43 @@ class TreeEstimatorMixin():
 
         if not node_data_rank_func is None:
             # datapoint_node_weights multiplication (columns)
-            #make copy
-            node_matrix = copy.deepcopy(node_matrix)
             #cast to csc to make .data order columnwise
-            node_matrix = node_matrix.tocsc()
-            datapoint_node_weights = self._calculate_node_datapoint_weights(y, node_matrix, node_data_rank_func)
-            node_matrix.data = node_matrix.data*np.concatenate(datapoint_node_weights)
-            #convert back to csr
-            node_matrix = node_matrix.tocsr()
+            csc_node_matrix = node_matrix.tocsc()
+            datapoint_node_weights = self._calculate_node_datapoint_weights(y, csc_node_matrix, node_data_rank_func)
+            #weighted data is put back in csr order, so the weighted matrix shares indices and indptr with node_matrix
+            node_matrix = self._with_csc_data(node_matrix, csc_node_matrix.data*datapoint_node_weights)
         else:
             pass
 
         return node_matrix
 
+    def _with_csc_data(self, matrix, csc_data):
+        '''
+        returns a csr matrix with the indices and indptr of the csr matrix `matrix` (shared, not copied)
+        and csc_data (in the data order of matrix.tocsc(), cast to matrix.dtype) as data
+        '''
+        csr_positions = scipy.sparse.csr_matrix(
+            (np.arange(matrix.nnz), matrix.indices, matrix.indptr), shape = matrix.shape).tocsc().data
+        data = np.empty(matrix.nnz, dtype = matrix.dtype)
+        data[csr_positions] = csc_data
+        return scipy.sparse.csr_matrix((data, matrix.indices, matrix.indptr), shape = matrix.shape, copy = False)
+
 # Cell
 #MAKE WARNING REGARDING NUMBER OF NODES IN TREE TAKING KNEIGHBORS QUERY INTO ACCOUNT, mayvbe set max_leaf_nodes automatically
-class KernelTreeEstimator(BaseEstimator, ClassifierMixin, DelegateEstimatorMixIn ,TreeEstimatorMixin):
+class KernelTreeEstimator(BaseEstimator, ClassifierMixin, DelegateEstimatorMixIn ,TreeEstimatorMixin, ChunkedPredictMixIn):
 
     def __init__(self, estimator, entropy_estimator_sampler = None, alpha = 1, beta = 1, gamma = 1, node_rank_func = None,
-                 node_data_rank_func = None,n_neighbors = 30, lower_bound = 0.0):
-
+                 node_data_rank_func = None,n_neighbors = 30, lower_bound = 0.0, query_engine = 'cossim', n_jobs = None, query_backend = None,
+                 dtype = np.float64):
+        '''
+        dtype is the storage dtype of the leaf node matrices, query spaces, node weights and y_ (if float)
+        '''
         #assert estimator.min_samples_leaf >= 3, 'min_samples_leaf should be greater than 2'
         assert hasattr(estimator, 'apply'), 'estimator should have `apply` method'
+        if not query_engine in ['cossim', 'inverted_index']:
+            raise ValueError(f'query_engine should be one of ["cossim", "inverted_index"], not {query_engine}')
+        if not np.issubdtype(dtype, np.floating):
+            raise TypeError(f'dtype should be a float dtype, not {dtype}')
 
         self.estimator = estimator
         self.n_neighbors = n_neighbors
@@ -873,6 +1330,10 @@ class KernelTreeEstimator(BaseEstimator, ClassifierMixin, DelegateEstimatorMixIn
         self.alpha = alpha
         self.beta = beta
         self.gamma = gamma
+        self.query_engine = query_engine
+        self.n_jobs = n_jobs
+        self.query_backend = query_backend
+        self.dtype = dtype
 
         if node_rank_func is None:
             self.node_rank_func = node_rank_func
@@ -915,18 +1376,26 @@ class KernelTreeEstimator(BaseEstimator, ClassifierMixin, DelegateEstimatorMixIn
         else:
             self._fit_entropy_estimator_sampler(X, y)
 
-        self.y_ = y
+        self.y_ = self._storage_array(y)
 
         return self
 
+    def partial_fit(self, X, y):
+        '''
+        adds new labelled rows to the leaf index without refitting the trees (see add_observations).
+        not supported (raises ValueError) for estimators with an entropy_estimator_sampler or leaf node matrices
+        subsampled with max_data, which should be refitted instead
+        '''
+        return self.add_observations(X, y)
+
     def density(self, X, dist = 'kde', sample_size = 1000, weight_func = None, n_neighbors = None,
-               lower_bound = None, alpha = None, beta = None, gamma = None, noise_factor = 1e-7, **dist_kwargs):
+               lower_bound = None, alpha = None, beta = None, gamma = None, noise_factor = 1e-7, columnar = False, **dist_kwargs):
 
         n_neighbors, lower_bound, alpha, beta, gamma = self._handle_similarity_sample_parameters(
             n_neighbors, lower_bound, alpha, beta, gamma)
 
         return super()._density(X, dist, sample_size, weight_func, n_neighbors,
-               lower_bound, alpha, beta, gamma, noise_factor, **dist_kwargs)
+               lower_bound, alpha, beta, gamma, noise_factor, columnar, **dist_kwargs)
 
     def sample(self, X, sample_size = 1000, weight_func = None, n_neighbors = None,
                lower_bound = None, alpha = None, beta = None, gamma = None, noise_factor = 0):
@@ -953,6 +1422,21 @@ class KernelTreeEstimator(BaseEstimator, ClassifierMixin, DelegateEstimatorMixIn
         n_neighbors, lower_bound, alpha, beta, gamma = self._handle_similarity_sample_parameters(n_neighbors, lower_bound, alpha, beta, gamma)
         return self._custom_predict(X, agg_func, sample_size, weights, n_neighbors, lower_bound, alpha, beta, gamma, noise_factor)
 
+    def predict_moments(self, X, weight_func = None, n_neighbors = None, lower_bound = None, alpha = None, beta = None, gamma = None):
+        '''
+        returns the exact mean and variance (arrays of shape (n_dists, n_dims)) of the distribution that `sample` draws from
+        '''
+        n_neighbors, lower_bound, alpha, beta, gamma = self._handle_similarity_sample_parameters(n_neighbors, lower_bound, alpha, beta, gamma)
+        return self._predict_moments(X, weight_func, n_neighbors, lower_bound, alpha, beta, gamma)
+
+    def predict_quantiles(self, X, q = [0.05, 0.5, 0.95], weight_func = None, n_neighbors = None, lower_bound = None,
+                          alpha = None, beta = None, gamma = None):
+        '''
+        returns the exact q quantiles (array of shape (n_dists, n_quantiles, n_dims)) of the distribution that `sample` draws from
+        '''
+        n_neighbors, lower_bound, alpha, beta, gamma = self._handle_similarity_sample_parameters(n_neighbors, lower_bound, alpha, beta, gamma)
+        return self._predict_quantiles(X, q, weight_func, n_neighbors, lower_bound, alpha, beta, gamma)
+
     def sample_histogram(self, X, weights, n_neighbors, lower_bound, alpha, beta, gamma):
         n_neighbors, lower_bound, alpha, beta, gamma = self._handle_similarity_sample_parameters(n_neighbors, lower_bound, alpha, beta, gamma)
         return self._similarity_empirical_pdf(X, weights, n_neighbors, lower_bound, alpha, beta, gamma)
@@ -979,12 +1463,14 @@ class KernelTreeHistogramEstimator(KernelTreeEstimator):
     '''
 
     def __init__(self, estimator, entropy_estimator_sampler=None, resolution='auto', cumulative_target = False, class_weight=None, alpha=1, beta=1, gamma=1, node_rank_func=None,
-                 node_data_rank_func=None, n_neighbors=30, lower_bound=0.0):
+                 node_data_rank_func=None, n_neighbors=30, lower_bound=0.0, query_engine='cossim', n_jobs=None, query_backend=None,
+                 dtype=np.float64):
 
         assert hasattr(estimator, 'predict_proba') or 'predict_proba' in dir(
             estimator), 'estimator should implement `predict_proba` method'
         super().__init__(estimator, entropy_estimator_sampler, alpha, beta, gamma, node_rank_func,
-                         node_data_rank_func, n_neighbors, lower_bound)
+                         node_data_rank_func, n_neighbors, lower_bound, query_engine, n_jobs, query_backend,
+                         dtype)
 
         self.cumulative_target = cumulative_target
         self.class_weight = class_weight
@@ -1056,18 +1542,10 @@ class KernelTreeHistogramEstimator(KernelTreeEstimator):
                     f'self.resolution should be np.array of bin edges, str or int, got {self.resolution.__class__}')
 
         if self.cumulative_target:
-            #make cumulative vector
-            y_transformed_list = []
-            for i in range(y_transformed.shape[-1]):
-
-                y_transformed_i = np.zeros((y_transformed.shape[0],max_bin[i]), dtype = 'int8')
-                for idx in range(len(y_transformed_i)):
-                    bin_idx = int(y_transformed[idx, i])
-                    y_transformed_i[i, :bin_idx] = 1
-
-                y_transformed_list.append(y_transformed[:,:-1]) #dropa last percentile to avoid all zeros
-
-            y_transformed = np.hstack(y_transformed_list)
+            #make cumulative vector for each dim, dropping last percentile to avoid all zeros
+            y_transformed = np.hstack([
+                cumulative_encode(y_transformed[:,i], max_bin[i]) for i in range(y_transformed.shape[-1])
+            ])
 
         return y_transformed
 
@@ -1129,7 +1607,7 @@ class KernelTreeHistogramEstimator(KernelTreeEstimator):
             self.estimator.fit(X, y_prep, **fit_kws)
 
         # save y continuous values
-        self.y_ = y
+        self.y_ = self._storage_array(y)
 
         # fit leaf node matrix with tree nodes and its respective continuous values (y)
         if self.entropy_estimator_sampler is None:
@@ -1237,13 +1715,13 @@ class JointHistogramEstimator(MultiOutputClassifier):
                                            alpha, beta, gamma, noise_factor,)
 
     def density(self, X, dist='kde', sample_size=10, weight_func=None, n_neighbors=None, lower_bound=None,
-                alpha=None, beta=None, gamma=None, noise_factor=1e-07, **dist_kwargs,):
+                alpha=None, beta=None, gamma=None, noise_factor=1e-07, columnar=False, **dist_kwargs,):
 
         marginal_results = self._make_stacked_predictors(
             X, self.stacking_method)
 
         return self.joint_tree_estimator.density(marginal_results, dist, sample_size, weight_func, n_neighbors, lower_bound,
-                                            alpha, beta, gamma, noise_factor, **dist_kwargs,)
+                                            alpha, beta, gamma, noise_factor, columnar, **dist_kwargs,)
 
     def custom_predict(self, X, agg_func, sample_size=100, weights=None, n_neighbors=None,
                        lower_bound=None, alpha=None, beta=None, gamma=None, noise_factor=0,):
@@ -1307,6 +1785,29 @@ class JointKernelTreeEstimator(MultiOutputClassifier):
         print(noise.shape, samples.shape)
         return add_noise(samples, noise_factor*noise)
 
+    def _similarity_empirical_pdf(self, X, weights=None, n_neighbors=10, lower_bound=0.0, alpha=1, beta=0, gamma=0):
+        '''
+        the distribution sampled by `sample` is an equally weighted mixture of the empirical distributions of each estimator,
+        so neighbors of all estimators are stacked, with their weights divided by the number of estimators
+        '''
+        idxs, ps = zip(*[
+            estim._similarity_empirical_idx_and_p(X, weights, n_neighbors, lower_bound, alpha, beta, gamma)
+            for estim in self.estimators_
+        ])
+        idx = np.hstack(idxs)
+        p = np.hstack(ps)/len(self.estimators_)
+        return self.y_[idx], p
+
+    def predict_moments(self, X, weights=None, n_neighbors=10, lower_bound=0.0, alpha=1, beta=0, gamma=0):
+        '''returns the exact mean and variance (arrays of shape (n_dists, n_dims)) of the distribution that `sample` draws from'''
+        values, p = self._similarity_empirical_pdf(X, weights, n_neighbors, lower_bound, alpha, beta, gamma)
+        return weighted_moments(values, p)
+
+    def predict_quantiles(self, X, q=[0.05, 0.5, 0.95], weights=None, n_neighbors=10, lower_bound=0.0, alpha=1, beta=0, gamma=0):
+        '''returns the exact q quantiles (array of shape (n_dists, n_quantiles, n_dims)) of the distribution that `sample` draws from'''
+        values, p = self._similarity_empirical_pdf(X, weights, n_neighbors, lower_bound, alpha, beta, gamma)
+        return weighted_quantile(values, p, q)
+
     def custom_predict(self, X, agg_func, sample_size=100, weights=None, n_neighbors=10,
                        lower_bound=0.0, alpha=1, beta=0, gamma=0, noise_factor=0):
 
@@ -1,25 +1,23 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: notebooks/04_metrics.ipynb (unless otherwise specified).
 
 __all__ = ['kde_entropy', 'kde_likelihood', 'ppf', 'cdf', 'quantile', 'kde_quantile', 'quantile_sklearn',
-           'theoretical_entropy', 'marginal_variance', 'covariance_matrix', 'bimodal_split', 'agg_smallest_distance',
-           'cov_smallest_distance', 'mad', 'bimodal_variance', 'gaussian_distance_entropy',
-           'expected_distance_gaussian_likelihood', 'distance_gaussian_likelihood', 'make_outlier_filter',
-           'filter_borders']
+           'theoretical_entropy', 'marginal_variance', 'weighted_moments', 'weighted_quantile', 'covariance_matrix',
+           'bimodal_split', 'agg_smallest_distance', 'cov_smallest_distance', 'mad', 'bimodal_variance',
+           'gaussian_distance_entropy', 'expected_distance_gaussian_likelihood', 'distance_gaussian_likelihood',
+           'make_outlier_filter', 'filter_borders']
 
 # Cell
-from tqdm.notebook import tqdm
-
 import numpy as np
 from sklearn.metrics import pairwise
 from scipy import stats
 from sklearn.preprocessing import QuantileTransformer
 
-from .core.random_variable import KDE, RandomVariable
+from .core.random_variable import KDE, BatchKDE, RandomVariable
 from .utils import (
-    draw_from,
+    draw_from, tqdm,
     _fix_one_sample_2d, _fix_one_dist_2d, _fix_dist_1d,
     _fix_X_1d, _assert_dim_3d, _assert_dim_1d, _assert_dim_2d, _fix_one_dist_1d,
-    _add_n_samples_axis
+    _add_n_samples_axis, _empirical_quantile, _empirical_rank
 )
 
 # Cell
@@ -46,27 +44,36 @@ def _check_kde_metrics_input(y_true, y_dists, frac):
     return y_true, y_dists
 
 # Cell
-def kde_entropy(data, sample_size = 200, frac = 1.0, progress_bar = False, **kde_kwargs):
+def kde_entropy(data, sample_size = 200, frac = 1.0, progress_bar = False, batch_memory = 2**28, **kde_kwargs):
     '''
     Calculates the entropy of multiple continuous distributions. entropy equals np.mean(-np.log(p(x)))
     input should be of shape (n_distributions, n_sample_per_distribution, n_dims_in_distribtuion)
+    if kde_kwargs are supported by BatchKDE, all distributions are fitted at once, in chunks of batch_memory bytes
     '''
     data = _fix_one_dist_2d(data)
     data = _assert_dim_3d(data)
-    kde = KDE(**kde_kwargs)
     data = draw_from(data, frac)
+    batch_kde = BatchKDE.from_kde_kws(batch_memory, **kde_kwargs)
+    if not batch_kde is None:
+        return batch_kde.fit(data).entropy(sample_size = sample_size)
+
+    kde = KDE(**kde_kwargs)
     if progress_bar:
         return np.array([kde.fit(d).entropy(sample_size = sample_size) for d in tqdm(data)])
     else:
         return np.array([kde.fit(d).entropy(sample_size = sample_size) for d in data])
 
 # Cell
-def kde_likelihood(y_true,y_dists, frac = 1.0, progress_bar = False,**kde_kwargs):
+def kde_likelihood(y_true,y_dists, frac = 1.0, progress_bar = False, batch_memory = 2**28, **kde_kwargs):
     '''
     Calculates the likelihood of y_true in kde estimation of samples
     input should be of shape (n_distributions, n_sample_per_distribution, n_dims_in_distribtuion)
+    if kde_kwargs are supported by BatchKDE, all distributions are fitted at once, in chunks of batch_memory bytes
     '''
     y_true, y_dists = _check_kde_metrics_input(y_true, y_dists, frac)
+    batch_kde = BatchKDE.from_kde_kws(batch_memory, **kde_kwargs)
+    if not batch_kde is None:
+        return _fix_dist_1d(batch_kde.fit(y_dists).evaluate(y_true))
 
     kde = KDE(**kde_kwargs)
     if progress_bar:
@@ -99,49 +106,46 @@ def _cdf(dist):
     temp = dist.argsort()
     return np.arange(len(dist))[temp.argsort()]/(len(dist)-1)
 
-def cdf(y_dists):
+def cdf(y_dists, chunk_size = None):
     '''
     returns the cdf of each element in each 1d dist
+    if chunk_size is not None, dists are processed in chunks of chunk_size
     '''
     y_dists = _assert_dim_3d(y_dists)
-    arr = np.zeros(y_dists.shape)
-    for dist in np.arange(y_dists.shape[0]):
-        for dim in np.arange(y_dists.shape[-1]):
-            arr[dist,:,dim] = _cdf(y_dists[dist,:,dim])
-
-    return arr
+    return _empirical_rank(y_dists, chunk_size = chunk_size)
 
 # Cell
-def quantile(y_true, y_dists):
+def quantile(y_true, y_dists, chunk_size = None):
     '''
     checks in which quantile lies y_true, given the predicted distribution
     y_true shape should be of shape (n_dists, n_samples ,n_dims)
     y_dists_should be of shape (n_dists, n_samples, n_dims)
+    if chunk_size is not None, dists are processed in chunks of chunk_size
     '''
 
     y_true = _fix_one_sample_2d(y_true)
     y_dists = _assert_dim_3d(y_dists)
     assert y_true.shape[0] == y_dists.shape[0], 'number of dists should be the same as number of points'
 
-    values = []
-    for i in range(y_true.shape[0]):
-        values.append([])
-        for j in range(y_true.shape[1]):
-            values[i].append((y_true[i,j].T >= y_dists[i]).mean(axis = 0))
-
-    return _fix_one_sample_2d(np.array(values))
+    return _empirical_quantile(y_true, y_dists, chunk_size = chunk_size)
 
 # Cell
-def kde_quantile(y_true, y_dists, frac = 1.0, progress_bar = False, **kde_kwargs):
+def kde_quantile(y_true, y_dists, frac = 1.0, progress_bar = False, batch_memory = 2**28, **kde_kwargs):
     '''
     fits a kde in a distribution and returns the quantile that a point in y_true belongs to in that distribution
+    if kde_kwargs are supported by BatchKDE, the exact marginal cdf of all distributions is computed at once.
+    returns array of shape (n_dists, n_points, n_dims) in both cases
     '''
     y_true, y_dists = _check_kde_metrics_input(y_true, y_dists, frac = 1)
+    batch_kde = BatchKDE.from_kde_kws(batch_memory, **kde_kwargs)
+    if not batch_kde is None:
+        return batch_kde.fit(y_dists).cdf(y_true)
     kde = KDE(**kde_kwargs)
+    #KDE.cdf returns a single dist array of shape (1, n_points, n_dims)
     if progress_bar:
-        return np.array([kde.fit(y_dists[i]).cdf(y_true[i]) for i in tqdm([*range(len(y_dists))])])
+        return np.array([kde.fit(y_dists[i]).cdf(y_true[i])[0] for i in tqdm([*range(len(y_dists))])])
     else:
-        return np.array([kde.fit(y_dists[i]).cdf(y_true[i]) for i in range(len(y_dists))])
+        return np.array([kde.fit(y_dists[i]).cdf(y_true[i])[0] for i in range(len(y_dists))])
 
 # Cell
 def quantile_sklearn(y_true, y_dists):
@@ -167,6 +171,48 @@ def marginal_variance(data):
     data = _assert_dim_3d(data)
     return data.var(axis = -2)
 
+# Cell
+def _normalize_weights(weights):
+    '''
+    l1 normalizes weights of shape (n_dists, n_samples) by row. rows that sum to zero get uniform weights
+    '''
+    weights = np.asarray(weights, dtype = float)
+    assert len(weights.shape) == 2, f'weights should have 2 dimensions: (n_dists, n_samples), got {len(weights.shape)}'
+    weights = np.where(weights.sum(axis = 1, keepdims = True) > 0, weights, 1.0)
+    return weights/weights.sum(axis = 1, keepdims = True)
+
+def weighted_moments(data, weights):
+    '''
+    exact mean and variance of each dimension (marginal) of multiple weighted empirical distributions.
+    data should be of shape (n_dists, n_samples, n_dims) and weights of shape (n_dists, n_samples).
+    returns mean and variance arrays, both of shape (n_dists, n_dims)
+    '''
+    data = _assert_dim_3d(data)
+    weights = _normalize_weights(weights)[:,:,None]
+    mean = (weights*data).sum(axis = 1)
+    variance = (weights*(data - mean[:,None,:])**2).sum(axis = 1)
+    return mean, variance
+
+def weighted_quantile(data, weights, q):
+    '''
+    exact quantiles (inverse of the weighted empirical cdf) of each dimension (marginal) of multiple
+    weighted empirical distributions.
+    data should be of shape (n_dists, n_samples, n_dims), weights of shape (n_dists, n_samples)
+    and q a float or 1d array of percentiles in [0,1]. returns array of shape (n_dists, n_quantiles, n_dims)
+    '''
+    data = _assert_dim_3d(data)
+    weights = _normalize_weights(weights)
+    q = np.atleast_1d(q).astype(float)
+    assert ((q >= 0) & (q <= 1)).all(), 'q values should be in the [0,1] interval'
+
+    order = data.argsort(axis = 1)
+    sorted_data = np.take_along_axis(data, order, axis = 1)
+    cum_weights = np.take_along_axis(np.broadcast_to(weights[:,:,None], data.shape), order, axis = 1).cumsum(axis = 1)
+    #first position where the cumulative weight reaches q, shape (n_dists, n_quantiles, n_dims)
+    positions = (cum_weights[:,None,:,:] < q[None,:,None,None] - 1e-12).sum(axis = 2)
+    positions = np.minimum(positions, data.shape[1] - 1)
+    return np.take_along_axis(sorted_data, positions, axis = 1)
+
 # Cell
 def covariance_matrix(data):
     '''
@@ -176,21 +222,36 @@ def covariance_matrix(data):
     raise NotImplementedError
 
 # Cell
+def _sorted_bimodal_split(sorted_data, filter_size = 3, lb = 0.1,ub = 0.9):
+    '''
+    splitting points of multiple distributions, already sorted along the samples axis.
+    sorted_data should be of shape (n_dists, n_samples, n_dims), returns array of shape (n_dists, n_dims)
+    '''
+    n_samples = sorted_data.shape[1]
+    filter_size = int(np.ceil(filter_size)) if filter_size >= 1 else int(max(1,np.ceil(n_samples*filter_size)))
+    #same as filter_borders along axis 1
+    data = sorted_data[:,int(n_samples*lb):int(n_samples*ub)]
+    if data.shape[1] < 2:
+        return sorted_data[:,int(n_samples*lb)] if data.shape[1] else sorted_data[:,n_samples//2]
+    diff = np.diff(data, axis = 1)
+    n_diffs = diff.shape[1]
+    #centered moving average of diff (as np.convolve(mode = 'same')), through cumulative sums
+    cumsum = np.concatenate([np.zeros_like(diff[:,:1]), diff.cumsum(axis = 1)], axis = 1)
+    window_end = np.minimum(np.arange(n_diffs) + (filter_size - 1)//2, n_diffs - 1) + 1
+    window_start = np.maximum(np.arange(n_diffs) + (filter_size - 1)//2 - filter_size + 1, 0)
+    moving_avg = (cumsum[:,window_end] - cumsum[:,window_start])/filter_size
+    argmax = moving_avg.argmax(axis = 1)[:,None,:]
+    upper = np.take_along_axis(data, np.minimum(data.shape[1] - 1, argmax + filter_size), axis = 1)
+    lower = np.take_along_axis(data, argmax, axis = 1)
+    return ((upper + lower)/2)[:,0,:]
+
 def bimodal_split(data, filter_size = 3, lb = 0.1,ub = 0.9):
     '''
     reutrns siplitting point of single distribution in two according to the highest value of the derivative of cpdf
     '''
 
     _assert_dim_1d(data)
-    filter_size = int(np.ceil(filter_size)) if filter_size >= 1 else int(max(1,np.ceil(data.shape[0]*filter_size)))
-    data.sort()
-    data = filter_borders(data,lb,ub)
-    diff = np.diff(data)
-    v = np.ones(filter_size)/filter_size
-    diff = np.convolve(a = diff,v = v, mode = 'same')
-    argmax = np.argmax(diff)
-    split_point = (data[min(data.shape[0] - 1,argmax + filter_size)] + data[argmax])/2
-    return split_point
+    return _sorted_bimodal_split(np.sort(data).reshape(1,-1,1), filter_size, lb, ub)[0,0]
 
 # Cell
 def agg_smallest_distance(data, agg_func = np.mean):
@@ -230,19 +291,16 @@ def bimodal_variance(data, filter_size = 0.05, lb = 0.1,ub = 0.9):
     returns weighted marginal variance of splitted data in two according to the highest value of the derivative of cpdf
     returns a variance array of shape (n_dists, n_dims)
     '''
-    data = _assert_dim_3d(data)
-    #make split point
-    #GENERALIZE FOR MULTIDIM
-    mses = []
-    for dist in range(data.shape[0]):
-        mses.append([])
-        for dim in range(data.shape[2]):
-            d = data[dist,:,dim]
-            split_point = bimodal_split(d, filter_size, lb ,ub)
-            arr1, arr2 = d[d >= split_point], d[d < split_point]
-            mses[dist].append((arr1.shape[0]*(arr1.var()) + arr2.shape[0]*(arr2.var()))/d.shape[0])
+    data = np.sort(_assert_dim_3d(data), axis = 1)
+    split_point = _sorted_bimodal_split(data, filter_size, lb, ub)[:,None,:]
+    #sum of squared deviations from the mean of each side of the split
+    squared_deviations = 0
+    for mask in [data >= split_point, data < split_point]:
+        n_side = mask.sum(axis = 1, keepdims = True)
+        side_mean = np.where(mask, data, 0).sum(axis = 1, keepdims = True)/np.maximum(n_side, 1)
+        squared_deviations = squared_deviations + np.where(mask, (data - side_mean)**2, 0).sum(axis = 1)
     #average variance
-    return np.array(mses)
+    return squared_deviations/data.shape[1]
 
 # Cell
 def gaussian_distance_entropy(data):
@@ -1,36 +1,56 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: notebooks/03_utils.ipynb (unless otherwise specified).
 
-__all__ = ['ctqdm', 'pad_to_shape', 'fix_samples_shape', 'count_unique_by_row', 'sample_idxs', 'draw_from',
+__all__ = ['ctqdm', 'pad_to_shape', 'fix_samples_shape', 'cumulative_encode', 'count_unique_by_row',
+           'check_random_generator', 'sample_idxs', 'inverse_cdf_sample', 'categorical_sample', 'draw_from',
            'sample_multi_dim', 'sample_from_dist_array', 'add_noise', 'add_multivariate_noise', 'sparse_mul_col',
-           'sparse_mul_row', 'transform_similarity_weights', 'sparse_dot_product', 'make_batches', 'cos_sim_query',
-           'sigmoid', 'make_bimodal_regression', 'make_distplot', 'DelegateEstimatorMixIn']
+           'sparse_mul_row', 'transform_query_vector', 'transform_query_space', 'transform_similarity_weights',
+           'sparse_dot_product', 'dump_csr', 'load_csr', 'dump_arrays', 'load_arrays', 'auto_n_batches', 'make_batches',
+           'csr_topk_to_dense', 'cos_sim_query', 'LeafEncoder', 'InvertedIndex', 'sigmoid', 'make_bimodal_regression',
+           'make_distplot', 'DelegateEstimatorMixIn', 'chunk_slices', 'ChunkedPredictMixIn']
 
 # Cell
 import copy
-from tqdm.notebook import tqdm
+import os
+import shutil
+import tempfile
+from warnings import warn
 #linalg
 import numpy as np
 from sklearn.decomposition import TruncatedSVD
 from sklearn.preprocessing import normalize
 from sklearn.neighbors import NearestNeighbors
 from sklearn.utils.fixes import _joblib_parallel_args
-from joblib import Parallel, delayed
-from multiprocessing import Pool
-
-from dask.diagnostics import ProgressBar
+from joblib import Parallel, delayed, effective_n_jobs
 
 import scipy
 
-try:
-    from sparse_dot_topn import awesome_cossim_topn
-except ImportError as e:
-    warn(f"{e}")
-    warn("sparse_dot_topn module not installed, will use naive dot product for vector query. This may lead to memory overload")
+#optional and heavy dependencies (sparse_dot_topn, tqdm, sklearn.datasets, seaborn, matplotlib) are imported on first use
+
+# Cell
+#lazy imports
+_OPTIONAL_MODULES = {}
 
-# data and viz
-from sklearn.datasets import make_regression
-import seaborn as sns
-import matplotlib.pyplot as plt
+def _import_awesome_cossim_topn():
+    '''
+    returns sparse_dot_topn.awesome_cossim_topn, imported on first call.
+    returns None (and warns once) if sparse_dot_topn is not installed
+    '''
+    if not 'awesome_cossim_topn' in _OPTIONAL_MODULES:
+        try:
+            from sparse_dot_topn import awesome_cossim_topn
+        except ImportError as e:
+            warn(f"{e}")
+            warn("sparse_dot_topn module not installed, will use naive dot product for vector query. This may lead to memory overload")
+            awesome_cossim_topn = None
+        _OPTIONAL_MODULES['awesome_cossim_topn'] = awesome_cossim_topn
+    return _OPTIONAL_MODULES['awesome_cossim_topn']
+
+def tqdm(iterable = None, *args, **kwargs):
+    '''
+    tqdm.notebook.tqdm progress bar, imported on first call (tqdm.notebook loads IPython widgets)
+    '''
+    from tqdm.notebook import tqdm as notebook_tqdm
+    return notebook_tqdm(iterable, *args, **kwargs)
 
 # Cell
 #auxiliary functions
@@ -42,9 +62,10 @@ def ctqdm(iterable, verbose = False, notebook = False,**tqdm_kwargs):
         return iterable
     else:
         if notebook:
-            return tqdm.notebook.tqdm(iterable,**tqdm_kwargs)
+            return tqdm(iterable,**tqdm_kwargs)
         else:
-            return tqdm.tqdm(iterable,**tqdm_kwargs)
+            from tqdm import tqdm as std_tqdm
+            return std_tqdm(iterable,**tqdm_kwargs)
 
 # Cell
 #shape fixing functions
@@ -191,6 +212,91 @@ def fix_samples_shape(samples):
     else:
         return samples
 
+# Cell
+def _count_less_equal(samples, queries):
+    '''
+    row wise count of samples less or equal than each query (same as np.searchsorted(np.sort(samples[i]), queries[i], side = 'right')),
+    for all rows at once with a single sort. samples should be of shape (n_rows, n_samples) and queries of shape (n_rows, n_queries)
+    '''
+    n_samples = samples.shape[1]
+    merged = np.concatenate([samples, queries], axis = 1)
+    #stable sort keeps samples before equal queries
+    order = merged.argsort(axis = 1, kind = 'stable')
+    n_samples_before = (order < n_samples).cumsum(axis = 1)
+    positions = np.empty_like(order)
+    np.put_along_axis(positions, order, np.broadcast_to(np.arange(order.shape[1]), order.shape), axis = 1)
+    return np.take_along_axis(n_samples_before, positions[:,n_samples:], axis = 1)
+
+def _empirical_quantile(y_true, y_dists, chunk_size = None):
+    '''
+    fraction of samples in each distribution that are less or equal than each point in y_true, for each dim.
+    y_true should be of shape (n_dists, n_points, n_dims) and y_dists of shape (n_dists, n_samples, n_dims).
+    returns array of shape (n_dists, n_points, n_dims). if chunk_size is not None, dists are processed in chunks of chunk_size
+    '''
+    n_dists, n_samples, n_dims = y_dists.shape
+    n_points = y_true.shape[1]
+    #for few points, direct comparison (O(n_points*n_samples)) is cheaper than sorting (O(n_samples*log(n_samples)))
+    compare = n_points <= np.log2(n_samples + n_points)
+    if chunk_size is None:
+        chunk_size = max(1, 2**26//(n_points*n_samples*n_dims)) if compare else n_dists
+    values = np.empty((n_dists, n_points, n_dims))
+    for start in range(0, n_dists, max(1, chunk_size)):
+        rows = slice(start, min(start + chunk_size, n_dists))
+        n_rows = rows.stop - rows.start
+        if compare:
+            values[rows] = (y_dists[rows][:,None,:,:] <= y_true[rows][:,:,None,:]).mean(axis = 2)
+            continue
+        #make one row for each (dist, dim) pair
+        samples = y_dists[rows].transpose(0,2,1).reshape(-1, n_samples)
+        queries = y_true[rows].transpose(0,2,1).reshape(-1, n_points)
+        counts = _count_less_equal(samples, queries)
+        values[rows] = counts.reshape(n_rows, n_dims, n_points).transpose(0,2,1)/n_samples
+    return values
+
+def _empirical_rank(y_dists, chunk_size = None):
+    '''
+    rank of each sample in its distribution and dim, scaled to [0,1].
+    y_dists should be of shape (n_dists, n_samples, n_dims). if chunk_size is not None, dists are processed in chunks of chunk_size
+    '''
+    n_dists, n_samples, n_dims = y_dists.shape
+    chunk_size = n_dists if chunk_size is None else chunk_size
+    ranks = np.empty(y_dists.shape)
+    for start in range(0, n_dists, max(1, chunk_size)):
+        rows = slice(start, min(start + chunk_size, n_dists))
+        order = y_dists[rows].argsort(axis = 1)
+        np.put_along_axis(ranks[rows], order, np.broadcast_to(np.arange(n_samples)[None,:,None], order.shape), axis = 1)
+    return ranks/(n_samples - 1)
+
+# Cell
+def cumulative_encode(bins, max_bin, output = 'dense', drop_last = True):
+    '''
+    cumulative (thermometer) encoding of bin ids: row i has ones in columns [0, bins[i]) of a (n_samples, max_bin) matrix.
+    if drop_last, last column is dropped to avoid all ones.
+    output can be "dense" (int8 array), "sparse" (int8 csr matrix) or "packed" (uint8 array of bits, packed along
+    columns as np.packbits, recoverable with np.unpackbits(packed, axis = 1, count = n_columns))
+    '''
+    bins = np.asarray(bins).reshape(-1).astype(int)
+    n_columns = max_bin - 1 if drop_last else max_bin
+    n_ones = np.clip(bins, 0, n_columns)
+
+    if output == 'dense':
+        return (n_ones[:,None] > np.arange(n_columns)[None,:]).astype('int8')
+
+    elif output == 'sparse':
+        indptr = np.concatenate([[0], n_ones.cumsum()])
+        indices = np.arange(indptr[-1]) - np.repeat(indptr[:-1], n_ones)
+        data = np.ones(indptr[-1], dtype = 'int8')
+        return scipy.sparse.csr_matrix((data, indices, indptr), shape = (len(bins), n_columns))
+
+    elif output == 'packed':
+        byte_idx = np.arange(int(np.ceil(n_columns/8)))[None,:]
+        full_bytes, remainder = (n_ones//8)[:,None], (n_ones%8)[:,None]
+        partial_byte = (255 << (8 - remainder)) & 255
+        return np.where(byte_idx < full_bytes, 255, np.where(byte_idx == full_bytes, partial_byte, 0)).astype('uint8')
+
+    else:
+        raise ValueError(f'output should be one of ["dense", "sparse", "packed"], not {output}')
+
 # Cell
 def count_unique_by_row(a):
     '''
@@ -204,15 +310,96 @@ def count_unique_by_row(a):
     np.put(b, ind, cnt)
     return b
 
-def sample_idxs(weights, sample_size, replace = True):
+def check_random_generator(random_state = None):
+    '''
+    returns a np.random.Generator instance.
+    random_state can be None, int, np.random.RandomState or np.random.Generator.
+    if None, the Generator is seeded from the global np.random state, so np.random.seed still makes results reproducible
+    '''
+    if isinstance(random_state, np.random.Generator):
+        return random_state
+    elif random_state is None:
+        return np.random.default_rng(np.random.randint(np.iinfo(np.int32).max))
+    elif isinstance(random_state, np.random.RandomState):
+        return np.random.default_rng(random_state.randint(np.iinfo(np.int32).max))
+    else:
+        return np.random.default_rng(random_state)
+
+def sample_idxs(weights, sample_size, replace = True, random_state = None):
     '''
     sample indexes based on weights array
     weights array should have shape (n_dists, n_draw_values)
     '''
     #make sure weights sum up to 1
     weights = normalize(weights, norm = 'l1', axis = 1)
-    sampled_idxs = [np.random.choice(np.arange(w.shape[0]), size = sample_size, p = w, replace = replace) for w in weights]
-    return np.array(sampled_idxs)
+    return categorical_sample(weights, sample_size, replace = replace, random_state = random_state)
+
+def _check_sampling_weights(weights):
+    '''
+    checks that weights of shape (n_dists, n_draw_values) are finite and non negative, and that every row has a positive sum
+    '''
+    weights = _assert_dim_2d(np.asarray(weights, dtype = float))
+    if not np.isfinite(weights).all():
+        raise ValueError('weights should not contain NaN or infinite values')
+    if (weights < 0).any():
+        raise ValueError('weights should be non negative')
+    if not (weights.sum(axis = 1) > 0).all():
+        raise ValueError(f'weights of every row should sum to a positive value. rows {np.flatnonzero(weights.sum(axis = 1) <= 0)} do not')
+    return weights
+
+def inverse_cdf_sample(weights, sample_size, random_state = None):
+    '''
+    sample indexes (with replacement) for all distributions at once, through inverse cdf lookup.
+    weights array should have shape (n_dists, n_draw_values)
+    returns an index array of shape (n_dists, sample_size)
+    '''
+    rng = check_random_generator(random_state)
+    weights = _check_sampling_weights(weights)
+    n_dists, n_values = weights.shape
+    cdf = np.cumsum(weights, axis = 1)
+    #make sure each row cdf ends in 1
+    cdf = cdf/cdf[:, -1:]
+    #shift each row by its row number, so a single searchsorted can be performed in the flattened array
+    offsets = np.arange(n_dists).reshape(-1,1)
+    u = rng.random(size = (n_dists, sample_size)) + offsets
+    sampled_idxs = np.searchsorted((cdf + offsets).ravel(), u.ravel(), side = 'right').reshape(n_dists, sample_size)
+    sampled_idxs = sampled_idxs - offsets*n_values
+    #handle float rounding at row borders
+    return np.clip(sampled_idxs, 0, n_values - 1)
+
+def _weighted_sample_without_replacement(weights, sample_size, rng):
+    '''
+    weighted sampling without replacement for all rows at once (Efraimidis-Spirakis keys).
+    the order of the returned indexes follows the order of successive draws, as in np.random.choice
+    '''
+    n_dists, n_values = weights.shape
+    if sample_size > n_values:
+        raise ValueError(f'Cannot take a larger sample than population when replace = False. got sample_size = {sample_size} and {n_values} values')
+    if ((weights > 0).sum(axis = 1) < sample_size).any():
+        raise ValueError('Fewer non-zero entries in weights than sample_size')
+
+    with np.errstate(divide = 'ignore'):
+        keys = np.log(rng.random(size = weights.shape))/weights
+
+    if sample_size < n_values:
+        top_k = np.argpartition(-keys, sample_size - 1, axis = 1)[:, :sample_size]
+    else:
+        top_k = np.broadcast_to(np.arange(n_values), weights.shape)
+    order = np.argsort(-np.take_along_axis(keys, top_k, axis = 1), axis = 1)
+    return np.take_along_axis(top_k, order, axis = 1)
+
+def categorical_sample(weights, sample_size, replace = True, random_state = None):
+    '''
+    batched categorical sampling. draws sample_size indexes from each row of weights in a single pass.
+    weights array should have shape (n_dists, n_draw_values). returns an index array of shape (n_dists, sample_size)
+    '''
+    rng = check_random_generator(random_state)
+    weights = _check_sampling_weights(weights)
+
+    if replace:
+        return inverse_cdf_sample(weights, sample_size, random_state = rng)
+    else:
+        return _weighted_sample_without_replacement(weights, sample_size, rng)
 
 def draw_from(arr, frac = 1.0, axis = 0, weights = None, replace = False,):
 
@@ -238,7 +425,7 @@ def sample_multi_dim(arr, sample_size, weights, replace = True, axis = 0):
     sampled_idxs = np.random.choice(np.arange(arr.shape[axis]), size = sample_size, p = weights, replace = replace)
     return np.take(arr, sampled_idxs, axis=axis)
 
-def sample_from_dist_array(arr, sample_size, weights = None, replace = True):
+def sample_from_dist_array(arr, sample_size, weights = None, replace = True, random_state = None):
     '''
     samples from array along axis
     array should be of shape (n_dists, n_sampels, n_dims)
@@ -250,16 +437,19 @@ def sample_from_dist_array(arr, sample_size, weights = None, replace = True):
         #normalize probas
         weights = weights/weights.sum(axis = -1).reshape(-1,1)
     else:
-        weights = [None for _ in range(arr.shape[0])]
+        weights = np.ones(arr.shape[:-1])
 
-    samples = [(sample_multi_dim(arr[i], sample_size, weights[i], replace = replace, axis = 0)) for i in range(arr.shape[0])]
-    return np.array(samples)
+    sampled_idxs = categorical_sample(weights, sample_size, replace = replace, random_state = random_state)
+    return np.take_along_axis(arr, sampled_idxs[:,:,None], axis = 1)
 
-def add_noise(x, std = 1e-6):
+def add_noise(x, std = 1e-6, random_state = None):
     '''
-    adds small white noise to array
+    adds small white noise to array.
+    if random_state is None, noise is drawn from the global np.random state
     '''
-    return x + np.random.normal(scale = std, size = x.shape)
+    if random_state is None:
+        return x + np.random.normal(scale = std, size = x.shape)
+    return x + check_random_generator(random_state).normal(scale = std, size = x.shape)
 
 def add_multivariate_noise(x, std):
     '''
@@ -284,43 +474,115 @@ def sparse_mul_row(arr, vector):
 # Cell
 #cossim query functions
 
-def transform_similarity_weights(query_vector, query_space, beta = 1, gamma = 1):
+def _stretch_and_normalize(matrix, factor):
     '''
-    handles query vector and query space using stretch factors beta and gamma
+    normalizes matrix rows, applies power `factor` to its values and normalizes again.
+    returns a new csr matrix, the input is never modified inplace
     '''
-    if not scipy.sparse.issparse(query_vector):
-        query_vector = scipy.sparse.csr_matrix(query_vector)
+    if not scipy.sparse.issparse(matrix):
+        matrix = scipy.sparse.csr_matrix(matrix)
 
-    if not scipy.sparse.issparse(query_space):
-        query_space = scipy.sparse.csr_matrix(query_space)
-
-    if gamma == 1:
-        query_space = normalize(query_space)
-    elif gamma == 0:
-        query_space.data = query_space.data**gamma
-        query_space = normalize(query_space)
+    if factor == 1:
+        return normalize(matrix)
+    elif factor == 0:
+        matrix = scipy.sparse.csr_matrix(matrix, copy = True)
     else:
-        #normalize, apply beta and normalize again
-        query_space = normalize(query_space)
-        query_space.data = query_space.data**gamma
-        query_space = normalize(query_space)
-
-    if beta == 1:
-        query_vector = normalize(query_vector)
-    elif beta == 0:
-        query_vector.data = query_vector.data**beta
-        query_vector = normalize(query_vector)
-    else:
-        #normalize, apply gamma and normalize again
-        query_vector = normalize(query_vector)
-        query_vector.data = query_vector.data**beta
-        query_vector = normalize(query_vector)
+        #normalize, apply factor and normalize again
+        matrix = normalize(matrix)
+
+    matrix.data = matrix.data**factor
+    return normalize(matrix)
 
-    return query_vector, query_space
+def transform_query_vector(query_vector, beta = 1):
+    '''
+    handles query vector using stretch factor beta
+    '''
+    return scipy.sparse.csr_matrix(_stretch_and_normalize(query_vector, beta))
+
+def transform_query_space(query_space, gamma = 1):
+    '''
+    handles query space using stretch factor gamma and transposes it, so it can be passed to cos_sim_query
+    with `query_space_is_transformed = True`. useful to transform the (large) query space once and reuse it across queries
+    '''
+    return scipy.sparse.csr_matrix(_stretch_and_normalize(query_space, gamma).T)
+
+def transform_similarity_weights(query_vector, query_space, beta = 1, gamma = 1):
+    '''
+    handles query vector and query space using stretch factors beta and gamma
+    '''
+    return _stretch_and_normalize(query_vector, beta), _stretch_and_normalize(query_space, gamma)
 
 def sparse_dot_product(A, B, ntop, lower_bound):
     '''dot product of two saprse matrices'''
-    return awesome_cossim_topn(A, B,ntop=ntop, lower_bound=lower_bound)
+    return _import_awesome_cossim_topn()(A, B,ntop=ntop, lower_bound=lower_bound)
+
+def dump_csr(matrix, folder, name = 'matrix'):
+    '''
+    saves the data, indices and indptr buffers (and shape) of a csr matrix as .npy files in folder,
+    so it can be memory mapped with load_csr
+    '''
+    matrix = scipy.sparse.csr_matrix(matrix)
+    os.makedirs(folder, exist_ok = True)
+    for buffer in ['data', 'indices', 'indptr']:
+        np.save(os.path.join(folder, f'{name}_{buffer}.npy'), getattr(matrix, buffer))
+    np.save(os.path.join(folder, f'{name}_shape.npy'), np.array(matrix.shape))
+    return folder
+
+def load_csr(folder, name = 'matrix', mmap_mode = 'r'):
+    '''
+    loads a csr matrix saved with dump_csr. by default, buffers are memory mapped read only,
+    so many processes can share the same page cached copy
+    '''
+    data, indices, indptr = [np.load(os.path.join(folder, f'{name}_{buffer}.npy'), mmap_mode = mmap_mode) for buffer in ['data', 'indices', 'indptr']]
+    shape = tuple(np.load(os.path.join(folder, f'{name}_shape.npy')))
+    return scipy.sparse.csr_matrix((data, indices, indptr), shape = shape, copy = False)
+
+def dump_arrays(state, folder, prefix = ''):
+    '''
+    saves the numpy arrays (as .npy files) and sparse matrices (as csr buffers, see dump_csr) found in the values of state dict
+    to folder. returns a copy of state with those values replaced by None and a manifest ({key:"array" or "sparse"}),
+    that should be passed to load_arrays
+    '''
+    os.makedirs(folder, exist_ok = True)
+    state, manifest = dict(state), {}
+    for key, value in state.items():
+        if scipy.sparse.issparse(value):
+            dump_csr(value, folder, f'{prefix}{key}')
+            manifest[key] = 'sparse'
+        elif isinstance(value, np.ndarray) and value.dtype != object:
+            np.save(os.path.join(folder, f'{prefix}{key}.npy'), value)
+            manifest[key] = 'array'
+        else:
+            continue
+        state[key] = None
+    return state, manifest
+
+def load_arrays(state, manifest, folder, prefix = '', mmap_mode = 'r'):
+    '''
+    restores in state (inplace) the arrays and sparse matrices saved with dump_arrays, memory mapped with mmap_mode
+    '''
+    for key, kind in manifest.items():
+        if kind == 'sparse':
+            state[key] = load_csr(folder, f'{prefix}{key}', mmap_mode = mmap_mode)
+        else:
+            state[key] = np.load(os.path.join(folder, f'{prefix}{key}.npy'), mmap_mode = mmap_mode)
+    return state
+
+def auto_n_batches(query_vector, n_neighbors, n_jobs = 1, batch_memory = 2**28):
+    '''
+    number of batches for a neighbors query, such that each batch result fits in batch_memory (bytes)
+    and there are enough batches to keep n_jobs workers busy
+    '''
+    n_rows = query_vector.shape[0]
+    if n_rows == 0:
+        return 1
+    nnz_per_row = query_vector.nnz/n_rows if scipy.sparse.issparse(query_vector) else query_vector.shape[1]
+    #value (8 bytes) and index (4 bytes) of each query input and result entry
+    row_memory = 12*(nnz_per_row + n_neighbors)
+    rows_per_batch = max(1, int(batch_memory//row_memory))
+    n_workers = effective_n_jobs(n_jobs)
+    n_batches = max(int(np.ceil(n_rows/rows_per_batch)), 4*n_workers if n_workers > 1 else 1)
+    return min(n_rows, n_batches)
 
 def make_batches(arr, batch_size = 100):
     '''make batches for batch query'''
@@ -340,68 +602,312 @@ def make_batches(arr, batch_size = 100):
             batches.append(arr[(i + 1) * batch_size:])
     return batches
 
-def cos_sim_query(query_vector, query_space, n_neighbors=50, lower_bound=0.0, beta = 1, gamma = 1, n_jobs = None, n_batches = 100):
+def csr_topk_to_dense(sim_matrix, k = None):
+    '''
+    builds padded dense (n_queries, k) idx and sim arrays from a csr top-k result matrix, straight from its
+    indptr/indices/data buffers. k defaults to the largest number of results in a row.
+    returns idx, sim and a boolean mask that is False in padded positions
+    '''
+    sim_matrix = scipy.sparse.csr_matrix(sim_matrix)
+    n_rows = sim_matrix.shape[0]
+    row_sizes = np.diff(sim_matrix.indptr)
+    if k is None:
+        k = int(row_sizes.max()) if n_rows else 0
+
+    #row and position inside row of each stored element
+    rows = np.repeat(np.arange(n_rows), row_sizes)
+    positions = np.arange(sim_matrix.nnz) - np.repeat(sim_matrix.indptr[:-1], row_sizes)
+    keep = positions < k
+    rows, positions = rows[keep], positions[keep]
+
+    idx = np.zeros((n_rows, k), dtype = int)
+    sim = np.zeros((n_rows, k), dtype = sim_matrix.data.dtype)
+    mask = np.zeros((n_rows, k), dtype = bool)
+    idx[rows, positions] = sim_matrix.indices[keep]
+    sim[rows, positions] = sim_matrix.data[keep]
+    mask[rows, positions] = True
+    return idx, sim, mask
+
+_MEMMAP_QUERY_SPACE = {}
+
+def _memmap_cossim_topn(query_vector, query_space_key, ntop, lower_bound, cache = True):
+    '''
+    process worker for cos_sim_query. the query space is memory mapped from the csr buffers in query_space_key
+    (folder, name, modification time), once per process if cache is True.
+    copy on write mapping is used since some sparse_dot_topn versions reject read only buffers (pages are still shared)
+    '''
+    if not cache:
+        query_space = load_csr(*query_space_key[:2], mmap_mode = 'c')
+        return _import_awesome_cossim_topn()(query_vector, query_space, ntop=ntop, lower_bound=lower_bound)
+    if not query_space_key in _MEMMAP_QUERY_SPACE:
+        _MEMMAP_QUERY_SPACE.clear()
+        _MEMMAP_QUERY_SPACE[query_space_key] = load_csr(*query_space_key[:2], mmap_mode = 'c')
+    return _import_awesome_cossim_topn()(query_vector, _MEMMAP_QUERY_SPACE[query_space_key], ntop=ntop, lower_bound=lower_bound)
+
+def _query_space_key(folder, name):
+    '''key of the worker query space cache. the modification time invalidates buffers that were dumped again in the same folder'''
+    return folder, name, os.stat(os.path.join(folder, f'{name}_data.npy')).st_mtime_ns
+
+def cos_sim_query(query_vector, query_space, n_neighbors=50, lower_bound=0.0, beta = 1, gamma = 1, n_jobs = None, n_batches = 'auto',
+                  return_mask = False, query_space_is_transformed = False, backend = None, batch_memory = 2**28,
+                  query_space_folder = None, query_space_name = 'query_space'):
     '''make cos similarity query of query_vector on query_space
     beta is a weightening factor such that query_space = normalize(query_space^beta)
     beta greater than one ensure higher magnitude components recieves more importance when querying
-    returns idx, sim
+    if query_space_is_transformed, query_space should be the output of transform_query_space (gamma is ignored),
+    so only query_vector is transformed in each call.
+    backend can be 'serial', 'threads' or 'processes'. if None, 'serial' is used when n_jobs is None and 'threads' otherwise.
+    the 'processes' backend shares the query space with the workers through memory mapped csr buffers instead of pickling it.
+    if query_space_folder is passed, it should contain the transformed query space dumped with dump_csr(query_space, query_space_folder,
+    query_space_name), and workers map it once and reuse it across calls. otherwise, the query space is dumped to a temporary folder in every call
+    if n_batches == 'auto', it is set from n_jobs and batch_memory (bytes per batch), see auto_n_batches
+    returns idx, sim (and a mask of the valid, non padded, positions if return_mask is True)
     '''
+    if backend is None:
+        backend = 'serial' if n_jobs is None else 'threads'
+    if not backend in ['serial', 'threads', 'processes']:
+        raise ValueError(f'backend should be one of ["serial", "threads", "processes"], not {backend}')
 
-    query_vector, query_space = copy.deepcopy(query_vector), copy.deepcopy(query_space)
-    query_vector, query_space = transform_similarity_weights(query_vector, query_space, beta, gamma)
+    query_vector = transform_query_vector(query_vector, beta)
+    if not query_space_is_transformed:
+        query_space = transform_query_space(query_space, gamma)
 
-    print(f'Querying {n_neighbors} nearest neighbors, this can take a while...')
-    if not scipy.sparse.issparse(query_vector):
-        query_vector = scipy.sparse.csr_matrix(query_vector)
+    if n_batches == 'auto':
+        n_batches = auto_n_batches(query_vector, n_neighbors, n_jobs = 1 if backend == 'serial' else n_jobs, batch_memory = batch_memory)
 
-    if not scipy.sparse.issparse(query_space):
-        query_space = scipy.sparse.csr_matrix(query_space)
-    try:
-        query_space = query_space.T
-        if n_jobs is None:
-            batches = make_batches(query_vector, batch_size = np.ceil(query_vector.shape[0]/n_batches).astype(int))
-            sim_matrix = [awesome_cossim_topn(qv, query_space,ntop=n_neighbors, lower_bound=lower_bound,) for qv in tqdm(batches)]
-            sim_matrix = scipy.sparse.vstack(sim_matrix)
-        else:
-            batches = make_batches(query_vector, batch_size = np.ceil(query_vector.shape[0]/n_batches).astype(int))
-
-            sim_matrix = Parallel(n_jobs=n_jobs, verbose=1,
-                                   **_joblib_parallel_args(prefer="threads"))(
-                    delayed(awesome_cossim_topn)(qv, query_space,
-                                             ntop=n_neighbors, lower_bound=lower_bound)
-                    for qv in batches)
-
-            sim_matrix = scipy.sparse.vstack(sim_matrix)
-
-        sim_matrix = scipy.sparse.csr_matrix(sim_matrix)
-        print('Postprocessing query results...')
-        idx = []
-        sim = []
-        arr_sizes = []
-        for d in sim_matrix:
-            s = d.data
-            i = d.nonzero()[1]
-            sim.append(s)
-            idx.append(i)
-            arr_sizes.append(len(s))
-
-        max_size = max(arr_sizes)
-        idx = np.array([pad_to_shape(i, max_size) for i in idx]).astype(int)
-        sim = np.array([pad_to_shape(s, max_size) for i in sim])
-        if idx.shape[1] == 0:
-            raise ValueError('No similarity greater than lower_bound found. Choose a lower threshold.')
-        return  idx, sim
-
-    except NameError: #in case sparse_dot_topn is not instaled
+    print(f'Querying {n_neighbors} nearest neighbors, this can take a while...')
+    awesome_cossim_topn = _import_awesome_cossim_topn()
+    if awesome_cossim_topn is None: #in case sparse_dot_topn is not instaled
         print('''sparse_dot_topn not installed. Neighbors query will use
         sklearn NearestNeighbor, which may take a while for sparse matrix query''')
         dist, idx = (
             NearestNeighbors(n_neighbors = n_neighbors, radius = 1 - lower_bound, metric = 'cosine', n_jobs = -1)
-            .fit(query_space)
+            .fit(query_space.T)
             .kneighbors(query_vector)
         )
+        if return_mask:
+            return idx, 1 - dist, np.ones(idx.shape, dtype = bool)
         return idx, 1 - dist # <- cos_sim = 1 - cos_dist
 
+    batches = make_batches(query_vector, batch_size = np.ceil(query_vector.shape[0]/n_batches).astype(int))
+    if backend == 'serial':
+        sim_matrix = [awesome_cossim_topn(qv, query_space,ntop=n_neighbors, lower_bound=lower_bound,) for qv in batches]
+    elif backend == 'threads':
+        sim_matrix = Parallel(n_jobs=n_jobs, verbose=1,
+                               **_joblib_parallel_args(prefer="threads"))(
+                delayed(awesome_cossim_topn)(qv, query_space,
+                                         ntop=n_neighbors, lower_bound=lower_bound)
+                for qv in batches)
+    elif not query_space_folder is None:
+        query_space_key = _query_space_key(query_space_folder, query_space_name)
+        sim_matrix = Parallel(n_jobs=n_jobs, verbose=1, backend='loky')(
+                delayed(_memmap_cossim_topn)(qv, query_space_key,
+                                         ntop=n_neighbors, lower_bound=lower_bound)
+                for qv in batches)
+    else:
+        query_space_folder = tempfile.mkdtemp(prefix = 'skdensity_query_space_')
+        try:
+            dump_csr(query_space, query_space_folder, 'query_space')
+            sim_matrix = Parallel(n_jobs=n_jobs, verbose=1, backend='loky')(
+                    delayed(_memmap_cossim_topn)(qv, (query_space_folder, 'query_space'),
+                                             ntop=n_neighbors, lower_bound=lower_bound, cache = False)
+                    for qv in batches)
+        finally:
+            shutil.rmtree(query_space_folder, ignore_errors = True)
+
+    sim_matrix = scipy.sparse.vstack(sim_matrix)
+
+    print('Postprocessing query results...')
+    idx, sim, mask = csr_topk_to_dense(sim_matrix)
+    if idx.shape[1] == 0:
+        raise ValueError('No similarity greater than lower_bound found. Choose a lower threshold.')
+    if return_mask:
+        return idx, sim, mask
+    return  idx, sim
+
+# Cell
+class LeafEncoder():
+    '''
+    one hot encoder of (n_rows, n_trees) leaf id arrays, such as the output of a forest apply method.
+    equivalent to OneHotEncoder(handle_unknown = 'ignore') (same columns, sorted by tree and leaf id), but categories
+    are stored as a flat lookup table (tree offset + leaf id -> column), so transform is a single vectorized gather
+    that builds the csr matrix directly. leaf ids should be small integers, as tree node ids are.
+    leaves not seen during fit (unknown) are encoded as zeros
+    '''
+
+    def __init__(self, dtype = np.float64):
+        self.dtype = dtype
+
+    def _check_leaves(self, leaves):
+        leaves = np.asarray(leaves)
+        _assert_dim_2d(leaves)
+        #some estimators (such as gradient boosting) return leaf ids as floats
+        return leaves.astype(np.int64, copy = False)
+
+    def fit(self, X, y = None):
+        leaves = self._check_leaves(X)
+        self.n_trees_ = leaves.shape[1]
+        self.min_leaf_ = leaves.min(axis = 0)
+        self.max_leaf_ = leaves.max(axis = 0)
+        table_sizes = self.max_leaf_ - self.min_leaf_ + 1
+        self.table_offsets_ = np.concatenate([[0], np.cumsum(table_sizes)[:-1]])
+        #sorted unique (tree, leaf) keys are the columns of the encoding
+        keys = np.unique((leaves - self.min_leaf_ + self.table_offsets_).ravel())
+        self.lookup_ = np.full(table_sizes.sum(), -1, dtype = np.int64)
+        self.lookup_[keys] = np.arange(keys.shape[0])
+        self.n_features_out_ = keys.shape[0]
+        return self
+
+    def transform(self, X):
+        '''
+        returns a csr matrix of shape (n_rows, n_features_out_) with one nonzero for each known leaf
+        '''
+        leaves = self._check_leaves(X)
+        if leaves.shape[1] != self.n_trees_:
+            raise ValueError(f'X should have {self.n_trees_} columns (trees), got {leaves.shape[1]}')
+        n_rows = leaves.shape[0]
+        positions = leaves - self.min_leaf_
+        in_range = (positions >= 0) & (leaves <= self.max_leaf_)
+        columns = np.where(in_range, self.lookup_[np.where(in_range, positions + self.table_offsets_, 0)], -1)
+        known = columns >= 0
+        if known.all():
+            indptr = np.arange(0, n_rows*self.n_trees_ + 1, self.n_trees_)
+            indices = columns.ravel()
+        else:
+            indptr = np.concatenate([[0], np.cumsum(known.sum(axis = 1))])
+            indices = columns[known]
+        data = np.ones(indices.shape[0], dtype = self.dtype)
+        matrix = scipy.sparse.csr_matrix((data, indices, indptr), shape = (n_rows, self.n_features_out_))
+        #columns increase with tree order, so each row is already sorted
+        matrix.has_sorted_indices = True
+        return matrix
+
+    def fit_transform(self, X, y = None):
+        return self.fit(X).transform(X)
+
+# Cell
+#inverted index query functions
+
+class InvertedIndex():
+    '''
+    Inverted index of a (n_keys, n_items) sparse query space, such as the transposed leaf node matrix of a forest.
+    each key (leaf) maps to a posting list of items (training rows) and their weights, sorted by descending weight.
+    Queries accumulate the weights of the posting lists reached by the query vector and keep the top n_neighbors items.
+    All the state is stored in flat numpy arrays, so the index can be pickled or saved with np.savez.
+    '''
+
+    def fit(self, query_space):
+        '''
+        builds posting lists from query_space of shape (n_keys, n_items).
+        query_space should be already transformed (see transform_query_space)
+        '''
+        query_space = scipy.sparse.csr_matrix(query_space)
+        n_keys, self.n_items_ = query_space.shape
+        posting_sizes = np.diff(query_space.indptr)
+        key_ids = np.repeat(np.arange(n_keys), posting_sizes)
+        #sort each posting list by descending weight
+        order = np.lexsort((-query_space.data, key_ids))
+        self.indptr_ = query_space.indptr.copy()
+        self.indices_ = query_space.indices[order]
+        self.data_ = query_space.data[order]
+        #max weight of each posting list, used to prune entries that cannot reach lower_bound
+        self.max_weights_ = np.zeros(n_keys)
+        not_empty = posting_sizes > 0
+        self.max_weights_[not_empty] = self.data_[self.indptr_[:-1][not_empty]]
+        #ascending sort keys within each posting list, to perform searchsorted in all lists at once
+        self._span = 2*np.abs(self.data_).max() + 1 if self.data_.size else 1
+        self._sort_keys = key_ids*self._span - self.data_
+        return self
+
+    def partial_fit(self, query_space):
+        '''
+        appends the items of query_space of shape (n_keys, n_new_items) to the index, as items n_items_ ... n_items_ + n_new_items - 1.
+        new entries are inserted in the sorted posting lists with a binary search, so existing lists are not sorted again
+        '''
+        query_space = scipy.sparse.csr_matrix(query_space)
+        n_keys = len(self.indptr_) - 1
+        assert query_space.shape[0] == n_keys, f'query_space should have {n_keys} rows, got {query_space.shape[0]}'
+        key_ids = np.repeat(np.arange(n_keys), np.diff(query_space.indptr))
+        span = max(self._span, 2*np.abs(query_space.data).max() + 1 if query_space.nnz else 1)
+        if span != self._span:
+            #sort order does not depend on span, only the sort keys have to be recomputed
+            self._span = span
+            self._sort_keys = np.repeat(np.arange(n_keys), np.diff(self.indptr_))*span - self.data_
+        sort_keys = key_ids*span - query_space.data
+        order = np.argsort(sort_keys, kind = 'stable')
+        positions = np.searchsorted(self._sort_keys, sort_keys[order], side = 'right')
+        self._sort_keys = np.insert(self._sort_keys, positions, sort_keys[order])
+        self.data_ = np.insert(self.data_, positions, query_space.data[order])
+        self.indices_ = np.insert(self.indices_, positions, query_space.indices[order] + self.n_items_)
+        self.indptr_ = self.indptr_ + np.concatenate([[0], np.cumsum(np.diff(query_space.indptr))])
+        not_empty = np.diff(self.indptr_) > 0
+        self.max_weights_ = np.zeros(n_keys)
+        self.max_weights_[not_empty] = self.data_[self.indptr_[:-1][not_empty]]
+        self.n_items_ += query_space.shape[1]
+        return self
+
+    def _posting_ranges(self, keys, weights, query_rows, n_queries, lower_bound):
+        '''
+        returns start and length of the useful part of each posting list reached by the query.
+        if lower_bound > 0, stops reading a posting list once its entries cannot reach lower_bound,
+        even if all the other lists contribute their max weight
+        '''
+        starts = self.indptr_[keys]
+        lengths = self.indptr_[keys + 1] - starts
+        if lower_bound > 0:
+            key_upper_bounds = weights*self.max_weights_[keys]
+            query_upper_bounds = np.bincount(query_rows, weights = key_upper_bounds, minlength = n_queries)
+            min_weights = (lower_bound - (query_upper_bounds[query_rows] - key_upper_bounds))/weights
+            ends = np.searchsorted(self._sort_keys, keys*self._span - min_weights, side = 'right')
+            lengths = np.clip(ends - starts, 0, lengths)
+        return starts, lengths
+
+    def _query_batch(self, query_vector, n_neighbors, lower_bound):
+        '''
+        returns a csr matrix with the top n_neighbors scores of each query row, sorted by descending score
+        '''
+        n_queries = query_vector.shape[0]
+        query_rows = np.repeat(np.arange(n_queries), np.diff(query_vector.indptr))
+        keys, weights = query_vector.indices, query_vector.data
+        starts, lengths = self._posting_ranges(keys, weights, query_rows, n_queries, lower_bound)
+
+        #gather all posting list entries and accumulate scores by (query, item)
+        offsets = np.cumsum(lengths) - lengths
+        entries = np.arange(lengths.sum()) - np.repeat(offsets - starts, lengths)
+        scores = scipy.sparse.csr_matrix(
+            (self.data_[entries]*np.repeat(weights, lengths), (np.repeat(query_rows, lengths), self.indices_[entries])),
+            shape = (n_queries, self.n_items_)
+        )
+        scores.data[scores.data <= lower_bound] = 0
+        scores.eliminate_zeros()
+
+        #sort by descending score inside each row and keep the top n_neighbors
+        score_rows = np.repeat(np.arange(n_queries), np.diff(scores.indptr))
+        order = np.lexsort((-scores.data, score_rows))
+        positions = np.arange(scores.nnz) - np.repeat(scores.indptr[:-1], np.diff(scores.indptr))
+        keep = positions < n_neighbors
+        row_sizes = np.minimum(np.diff(scores.indptr), n_neighbors)
+        return scipy.sparse.csr_matrix(
+            (scores.data[order][keep], scores.indices[order][keep], np.concatenate([[0], np.cumsum(row_sizes)])),
+            shape = scores.shape
+        )
+
+    def query(self, query_vector, n_neighbors = 50, lower_bound = 0.0, batch_size = 1000, return_mask = False):
+        '''
+        query the top n_neighbors items of each row in query_vector (n_queries, n_keys).
+        query_vector should be already transformed (see transform_query_vector)
+        returns idx, sim (and a mask of the valid, non padded, positions if return_mask is True)
+        '''
+        query_vector = scipy.sparse.csr_matrix(query_vector)
+        batches = make_batches(query_vector, batch_size = batch_size)
+        sim_matrix = scipy.sparse.vstack([self._query_batch(batch, n_neighbors, lower_bound) for batch in batches])
+        idx, sim, mask = csr_topk_to_dense(sim_matrix)
+        if idx.shape[1] == 0:
+            raise ValueError('No similarity greater than lower_bound found. Choose a lower threshold.')
+        if return_mask:
+            return idx, sim, mask
+        return idx, sim
+
 # Cell
 def sigmoid(x):
     return 1/(1+np.exp(x))
@@ -410,6 +916,7 @@ def make_bimodal_regression(n_samples, split_frac = 0.8, bimodal_inbalance = 0,
     '''make 2d bimodal regression dataset
     returns X_train, y_train, X_test, y_test
     '''
+    from sklearn.datasets import make_regression
 
     X,y = make_regression(
         n_samples=10000,
@@ -438,6 +945,7 @@ def make_bimodal_regression(n_samples, split_frac = 0.8, bimodal_inbalance = 0,
 
 # Cell
 def make_distplot(sample,true_value,y_test,):
+    import seaborn as sns
 
     if (len(sample.shape) > 1) and (sample.shape[-1] == 2):
         jntplot = sns.jointplot(sample[:,0], sample[:,1], joint_kws = {'label':'Model Samples', 'alpha':1})
@@ -466,4 +974,69 @@ class DelegateEstimatorMixIn(object):
         elif (attr in dir(self.estimator)) or (attr in list(self.estimator.__dict__)) and (not self.estimator):
             return object.__getattribute__(self.estimator, attr)
         else:
-            return object.__getattribute__(self, attr) #raise key error
\ No newline at end of file
+            return object.__getattribute__(self, attr) #raise key error
+
+# Cell
+def chunk_slices(n_rows, chunk_size = 1000):
+    '''yields consecutive slices of at most chunk_size rows covering range(n_rows)'''
+    assert chunk_size > 0, f'chunk_size should be greater than 0, not {chunk_size}'
+    for start in range(0, n_rows, chunk_size):
+        yield slice(start, min(start + chunk_size, n_rows))
+
+def _take_rows(X, rows):
+    '''positional row slicing of arrays, sparse matrices and dataframes'''
+    if hasattr(X, 'iloc'):
+        return X.iloc[rows]
+    return X[rows]
+
+class ChunkedPredictMixIn(object):
+    '''
+    class to add memory bounded, generator based versions of `sample` and `density`.
+    X is processed in chunks of chunk_size rows, so only one chunk of results is held in memory at a time.
+    parent class should implement `sample` and `density` methods
+    '''
+    def _iter_chunked(self, method, X, chunk_size, out, **method_kws):
+        '''
+        validates out when called, and returns a generator over the chunks of X.
+        each chunk is written to out (and flushed, in case of np.memmap) before it is yielded
+        '''
+        n_rows = X.shape[0]
+        if not out is None and out.shape[0] != n_rows:
+            raise ValueError(f'out should have {n_rows} rows, got {out.shape[0]}')
+        assert chunk_size > 0, f'chunk_size should be greater than 0, not {chunk_size}'
+        return self._chunk_generator(method, X, chunk_size, out, **method_kws)
+
+    def _chunk_generator(self, method, X, chunk_size, out, **method_kws):
+        #imported here, since core.random_variable imports utils
+        from .core.random_variable import CustomArray
+
+        for rows in chunk_slices(X.shape[0], chunk_size):
+            result = method(_take_rows(X, rows), **method_kws)
+            if not out is None:
+                out[rows] = result.data if isinstance(result, CustomArray) else result #RVArray objects are written from its data
+                if hasattr(out, 'flush'):
+                    out.flush()
+            yield result
+
+    def iter_sample(self, X, chunk_size = 1000, out = None, **sample_kws):
+        '''
+        same as sample, but yields arrays of shape (chunk_size, sample_size, n_dims) for each chunk of X.
+        if out is passed (an array or np.memmap of shape (n_rows, sample_size, n_dims)) chunks are also written to it.
+        out is validated when iter_sample is called, not when iteration starts
+        '''
+        if not out is None:
+            if len(out.shape) != 3:
+                raise ValueError(f'out should be of shape (n_rows, sample_size, n_dims), got {out.shape}')
+            if 'sample_size' in sample_kws and out.shape[1] != sample_kws['sample_size']:
+                raise ValueError(f'out should have sample_size ({sample_kws["sample_size"]}) columns, got {out.shape[1]}')
+        return self._iter_chunked(self.sample, X, chunk_size, out, **sample_kws)
+
+    def iter_density(self, X, chunk_size = 1000, out = None, **density_kws):
+        '''
+        same as density, but yields an RVArray for each chunk of X.
+        if out is passed (an object array of shape (n_rows,)) the RandomVariable objects are also written to it.
+        out is not supported for columnar results (BatchRVArray), use iter_sample with out to store the samples instead
+        '''
+        if not out is None and density_kws.get('columnar', False):
+            raise ValueError('out is not supported when columnar = True. use iter_sample with out to store the samples instead')
+        return self._iter_chunked(self.density, X, chunk_size, out, **density_kws)